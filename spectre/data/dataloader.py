@@ -41,6 +41,13 @@ class DataLoader:
         """ data source last modification time """
         raise NotImplementedError("abstractmethod")
 
+    @property
+    def fingerprint(self) -> str:
+        """ identify the data source, its settings and its version, used for caching """
+        settings = sorted((k, repr(v)) for k, v in vars(self).items()
+                          if isinstance(v, (type(None), bool, int, float, str, tuple)))
+        return '{}{}@{}'.format(type(self).__name__, settings, self.last_modified)
+
     @classmethod
     def _align_to(cls, df, calender_asset, align_by_time=False):
         """ helper method for align index """
@@ -48,9 +55,36 @@ class DataLoader:
         df = df[df.index.get_level_values(0).isin(index)]
         df.index = df.index.remove_unused_levels()
         if align_by_time:
-            df = df.reindex(pd.MultiIndex.from_product(df.index.levels))
+            df = cls.reindex_product(df)
         return df
 
+    @classmethod
+    def reindex_product(cls, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Same as `df.reindex(pd.MultiIndex.from_product(df.index.levels))`, but scatter the rows
+        into the grid by the level codes, instead of slow MultiIndex lookups.
+        """
+        index = df.index
+        shape = tuple(map(len, index.levels))
+        size = np.prod(shape)
+        rows = np.ravel_multi_index(index.codes, shape)
+        indexer = None
+        data = {}
+        for i in range(df.shape[1]):
+            values = df.iloc[:, i].values
+            if values.dtype.kind == 'f':
+                data[i] = np.full(size, np.nan, dtype=values.dtype)
+                data[i][rows] = values
+            else:
+                # let pandas handle the type promotion of missing values
+                if indexer is None:
+                    indexer = np.full(size, -1, dtype=np.intp)
+                    indexer[rows] = np.arange(len(df))
+                data[i] = pd.api.extensions.take(values, indexer, allow_fill=True)
+        ret = pd.DataFrame(data, index=pd.MultiIndex.from_product(index.levels, names=index.names))
+        ret.columns = df.columns
+        return ret
+
     def _format(self, df, split_ratio_is_inverse=False) -> pd.DataFrame:
         """
         Format the data as we want it. df index must be in order [datetime, asset_name]
@@ -176,6 +210,14 @@ class DataLoader:
         backward_start = index[backward_loc]
         return df.loc[backward_start:end]
 
+    def groupby_layout(self, df: pd.DataFrame, group: str) -> Optional[tuple]:
+        """
+        Return (stable sorted row order, size of each non-empty group) of `df` grouped by
+        `group` ('asset' or a column name), `df` must be a date range returned by `load()`.
+        Return None if the layout is unknown, then engine will sort the keys itself.
+        """
+        return None
+
 
 class ArrowLoader(DataLoader):
     """ Read from persistent data. """
@@ -189,6 +231,7 @@ class ArrowLoader(DataLoader):
         super().__init__(path, ohlcv, adjustments)
         self.keep_in_memory = keep_in_memory
         self._cache = None
+        self._groupby_index = None
 
     @classmethod
     def _last_modified(cls, filepath) -> float:
@@ -218,6 +261,65 @@ class ArrowLoader(DataLoader):
         meta.adjustments[:2] = source.adjustments
         meta.to_feather(save_to + '.meta')
 
+        # group by index of the full data, write at last, so it is newer than data file
+        dates = pd.DatetimeIndex(df.date)
+        unique_dates = dates.unique()
+        index = dict(
+            dates=unique_dates.asi8,
+            date_offsets=np.append(dates.searchsorted(unique_dates), len(df)),
+        )
+        keys = {'asset': df.asset.cat.codes.values,
+                source.time_category: df[source.time_category].values}
+        for group, key in keys.items():
+            sorted_indices = np.argsort(key, kind='stable')
+            _, counts = np.unique(key[sorted_indices], return_counts=True)
+            index[group + '_sorted'] = sorted_indices
+            index[group + '_boundary'] = np.append(0, np.cumsum(counts))
+        np.savez(save_to + '.idx.npz', **index)
+
+    def _load_groupby_index(self) -> Optional[dict]:
+        if self._groupby_index is not None:
+            return self._groupby_index
+        file = self._path + '.idx.npz'
+        if self._last_modified(file) < self.last_modified:
+            return None
+        with np.load(file) as npz:
+            index = dict(npz)
+        rows = index['date_offsets'][-1] + 1
+        for key in list(index.keys()):
+            if key.endswith('_boundary'):
+                group = key[:-len('_boundary')]
+                # group_id * rows + row_id, sorted, for searching the range of each group
+                counts = np.diff(index[key])
+                group_ids = np.repeat(np.arange(len(counts)), counts)
+                index[group + '_search'] = group_ids * rows + index[group + '_sorted']
+        if self.keep_in_memory:
+            self._groupby_index = index
+        return index
+
+    def groupby_layout(self, df: pd.DataFrame, group: str) -> Optional[tuple]:
+        index = self._load_groupby_index()
+        if index is None or group + '_search' not in index or len(df) == 0:
+            return None
+        # row range of df in the full data
+        dates, date_offsets = index['dates'], index['date_offsets']
+        first, last = df.index[0][0].value, df.index[-1][0].value
+        first_loc, last_loc = dates.searchsorted([first, last])
+        if last_loc >= len(dates) or dates[first_loc] != first or dates[last_loc] != last:
+            return None
+        row_start, row_end = date_offsets[first_loc], date_offsets[last_loc + 1]
+        if row_end - row_start != len(df):
+            return None
+        # rows of each group in range
+        rows = date_offsets[-1] + 1
+        search = index[group + '_search']
+        group_start = np.arange(len(index[group + '_boundary']) - 1) * rows
+        lo = search.searchsorted(group_start + row_start)
+        counts = search.searchsorted(group_start + row_end) - lo
+        lo, counts = lo[counts > 0], counts[counts > 0]
+        take = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return index[group + '_sorted'][take] - row_start, counts
+
     def _load(self) -> pd.DataFrame:
         if self._cache is not None:
             return self._cache
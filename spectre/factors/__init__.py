@@ -1,5 +1,6 @@
 from .engine import (
     FactorEngine,
+    FactorResult,
     OHLCV,
 )
 
@@ -8,11 +9,13 @@ from .factor import (
     CustomFactor,
     RankFactor,
     QuantileFactor,
+    FusedFactor,
 )
 
 from .datafactor import (
     DataFactor,
     AdjustedDataFactor,
+    GroupIdFactor,
 )
 
 from .filter import (
@@ -40,6 +43,11 @@ from .technical import (
     TrueRange, TRANGE,
     RSI,
     FastStochasticOscillator, STOCHF,
+    WildersSmoothedFactor,
+    WilderRSI,
+    AverageTrueRange, ATR,
+    AverageDirectionalIndex, ADX,
+    ChaikinOscillator, ADOSC,
 )
 
 from .statistical import (
@@ -47,4 +55,7 @@ from .statistical import (
     RollingHigh, MAX,
     RollingLow, MIN,
     RollingLinearRegression,
+    RollingRank, TS_RANK,
+    RollingQuantile,
+    RollingMedian,
 )
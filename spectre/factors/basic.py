@@ -6,10 +6,8 @@
 """
 from typing import Optional, Sequence
 from .factor import BaseFactor, CustomFactor
-from ..parallel import nansum, nanmean
+from ..parallel import nansum, nanema
 from .engine import OHLCV
-import numpy as np
-import torch
 
 
 class Returns(CustomFactor):
@@ -47,7 +45,7 @@ class WeightedAverageValue(CustomFactor):
         def _weight_mean(_base, _weight):
             return nansum(_base * _weight, dim=2) / nansum(_weight, dim=2)
 
-        return base.agg(_weight_mean, weight)
+        return base.agg(_weight_mean, weight, footprint=1.5)
 
 
 class VWAP(WeightedAverageValue):
@@ -65,30 +63,18 @@ class ExponentialWeightedMovingAverage(CustomFactor):
         self.span = self.win
         self.alpha = (2.0 / (1.0 + self.span))
         self.adjust = adjust
+        # EMA is computed by exact recursion from the first value of window, so the result
+        # doesn't depend on how much history is loaded (such as chunked or incremental run).
         # Length required to achieve 99.97% accuracy, np.log(1-99.97/100) / np.log(alpha)
         # simplification to 4 * (span+1). 3.45 achieve 99.90%, 2.26 99.00%
         self.win = int(4.5 * (self.span + 1))
-        # For GPU efficiency here, weight is not float64 type, EMA 50+ will leading to inaccurate,
-        # and so window greater than 200 produces a very small and negligible weight
-        self.win = min(self.win, 200)
-        self.weight = np.full(self.win, 1 - self.alpha) ** np.arange(self.win - 1, -1, -1)
-        if self.adjust:
-            self.weight = self.weight / sum(self.weight)  # to sum one
-
-    def pre_compute_(self, engine, start, end) -> None:
-        super().pre_compute_(engine, start, end)
-        if not isinstance(self.weight, torch.Tensor):
-            self.weight = torch.tensor(self.weight, dtype=torch.float32, device=engine.device)
 
     def compute(self, data):
-        weighted_mean = data.agg(lambda x: nansum(x * self.weight, dim=2))
-        if self.adjust:
-            return weighted_mean
-        else:
-            shifted = data.last().roll(self.win - 1, dims=1)
-            shifted[:, 0:self.win - 1] = 0
-            alpha = self.alpha
-            return alpha * weighted_mean + (shifted * (1 - alpha) ** self.win)
+        x, last = data.whole_series()
+        ret = nanema(x, self.alpha, self.adjust, self.win)
+        if last is not None:
+            ret = ret / last
+        return ret.to(data.x.dtype)
 
 
 class AverageDollarVolume(CustomFactor):
@@ -98,7 +84,7 @@ class AverageDollarVolume(CustomFactor):
         if self.win == 1:
             return closes * volumes
         else:
-            return closes.agg(lambda c, v: nanmean(c * v, dim=2), volumes)
+            return (closes * volumes).nanmean()
 
 
 class AnnualizedVolatility(CustomFactor):
@@ -0,0 +1,137 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2019-2020, Heerozh. All rights reserved.
+@license: Apache 2.0
+@email: heeroz@gmail.com
+"""
+from typing import Optional
+from functools import lru_cache
+import hashlib
+import marshal
+import os
+import uuid
+import numpy as np
+import torch
+
+
+_SIMPLE_TYPES = (type(None), bool, int, float, str)
+
+
+def _class_fingerprint(cls: type) -> bytes:
+    """Name and code of the class and its bases, so a modified factor class gets a new key."""
+    hasher = hashlib.sha1()
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        hasher.update('{}.{}'.format(klass.__module__, klass.__qualname__).encode())
+        for name, member in sorted(vars(klass).items()):
+            if isinstance(member, (staticmethod, classmethod)):
+                member = member.__func__
+            elif isinstance(member, property):
+                member = member.fget
+            if hasattr(member, '__code__'):
+                hasher.update(name.encode())
+                hasher.update(marshal.dumps(member.__code__))
+            elif not name.startswith('__') and isinstance(member, _SIMPLE_TYPES):
+                hasher.update('{}={!r}'.format(name, member).encode())
+    return hasher.digest()
+
+
+@lru_cache(maxsize=None)
+def _library_fingerprint() -> bytes:
+    """Code of the parallel algorithms, they are not in the factor classes but change results."""
+    from ..parallel import algorithmic
+    with open(algorithmic.__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+def _feed_key(hasher, key) -> bool:
+    """Feed structure key into hasher, return False if key contains session dependent value."""
+    if isinstance(key, tuple):
+        if len(key) == 2 and key[0] == '__id__':
+            return False
+        hasher.update(b'(')
+        for k in key:
+            if not _feed_key(hasher, k):
+                return False
+        hasher.update(b')')
+    elif isinstance(key, type):
+        hasher.update(_class_fingerprint(key))
+    elif isinstance(key, bytes):
+        hasher.update(hashlib.sha1(key).digest())
+    elif isinstance(key, _SIMPLE_TYPES):
+        hasher.update(repr(key).encode())
+    else:
+        return False
+    return True
+
+
+class FactorResultCache:
+    """
+    Persistent cache of the reverted factor results, each result saved as a npy file in `path`.
+    When the total size of files exceeds `max_bytes`, the least recently used files are removed.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def digest(cls, structure_key: tuple, data_key: tuple) -> Optional[str]:
+        """
+        Return the file name of a factor result, None if the factor can't be cached,
+        such as a factor has a lambda member.
+        """
+        hasher = hashlib.sha1(torch.__version__.encode())
+        hasher.update(_library_fingerprint())
+        if not _feed_key(hasher, structure_key) or not _feed_key(hasher, data_key):
+            return None
+        return hasher.hexdigest()
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.path, digest + '.npy')
+
+    def get(self, digest: Optional[str], length: int) -> Optional[np.ndarray]:
+        if digest is None:
+            return None
+        file = self._file(digest)
+        try:
+            data = np.load(file)
+        except (OSError, ValueError):
+            return None
+        if data.shape[0] != length:
+            return None
+        os.utime(file)  # mark as recently used
+        return data
+
+    def put(self, digest: Optional[str], data: np.ndarray) -> None:
+        if digest is None:
+            return
+        # write to a temp file first, prevent other process reading incomplete file
+        tmp = os.path.join(self.path, '{}.{}.tmp'.format(digest, uuid.uuid4().hex))
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, self._file(digest))
+        self.evict()
+
+    def evict(self) -> None:
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                os.remove(entry.path)
@@ -7,10 +7,14 @@
 from typing import Optional, Sequence, Union
 from ..parallel import nanlast
 from .factor import BaseFactor, CustomFactor
+import numpy as np
+import pandas as pd
 import torch
 
 
 class DataFactor(BaseFactor):
+    _runtime_members = BaseFactor._runtime_members + ('_data', '_multi')
+
     def __init__(self, inputs: Optional[Sequence[str]] = None,
                  is_data_after_market_close=True) -> None:
         super().__init__()
@@ -33,13 +37,20 @@ class DataFactor(BaseFactor):
     def include_close_data(self) -> bool:
         return self.is_data_after_market_close
 
+    def _split_column(self, engine, column: str) -> torch.Tensor:
+        data = engine.column_to_tensor_(column)
+        ret = engine.group_by_(data, self.groupby)
+        # aligned group by splits to a view, but the column tensor is cached by engine
+        # across runs, so downstream in-place ops must not modify it
+        if ret.data_ptr() == data.data_ptr():
+            ret = ret.clone()
+        return ret
+
     def pre_compute_(self, engine, start, end) -> None:
         super().pre_compute_(engine, start, end)
-        self._data = engine.column_to_tensor_(self.inputs[0])
-        self._data = engine.group_by_(self._data, self.groupby)
+        self._data = self._split_column(engine, self.inputs[0])
         if len(self.inputs) > 1 and self.inputs[1] in engine.dataframe_:
-            self._multi = engine.column_to_tensor_(self.inputs[1])
-            self._multi = engine.group_by_(self._multi, self.groupby)
+            self._multi = self._split_column(engine, self.inputs[1])
         else:
             self._multi = None
 
@@ -55,6 +66,42 @@ class DataFactor(BaseFactor):
         pass
 
 
+class GroupIdFactor(BaseFactor):
+    """
+    Group key of each row, from a data column (such as 'sector'), or a dict of {asset: group},
+    assets not in the dict are in the same group. Used as the `groupby` input of rank, zscore,
+    demean and quantile.
+    """
+    groupby = 'date'
+    _runtime_members = BaseFactor._runtime_members + ('_data',)
+
+    def __init__(self, group: Union[str, dict]) -> None:
+        super().__init__()
+        self.group = group
+        self._data = None
+
+    def get_total_backwards_(self) -> int:
+        return 0
+
+    def pre_compute_(self, engine, start, end) -> None:
+        super().pre_compute_(engine, start, end)
+        df = engine.dataframe_
+        if isinstance(self.group, dict):
+            assets = df.index.levels[1]
+            codes, _ = pd.factorize(pd.Series([self.group.get(a) for a in assets], dtype=object))
+            keys = codes[df.index.codes[1]]
+        else:
+            keys, _ = pd.factorize(df[self.group])
+        self._data = engine.group_by_(keys.astype(np.float64), self.groupby)
+
+    def clean_up_(self) -> None:
+        super().clean_up_()
+        self._data = None
+
+    def compute_(self, stream: Union[torch.cuda.Stream, None]) -> torch.Tensor:
+        return self._data
+
+
 class AdjustedDataFactor(CustomFactor):
     def __init__(self, data: DataFactor):
         super().__init__(1, (data,))
@@ -4,14 +4,22 @@
 @license: Apache 2.0
 @email: heeroz@gmail.com
 """
-from typing import Union, Iterable, Tuple
+from typing import Union, Iterable, Tuple, Callable
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import contextlib
+import copy
+import threading
 import warnings
-from .factor import BaseFactor
+from .factor import BaseFactor, CustomFactor, FusedFactor, get_fused_function
 from .filter import FilterFactor, StaticAssets
 from .datafactor import DataFactor, AdjustedDataFactor
 from .plotting import plot_quantile_and_cumulative_returns
+from .cache import FactorResultCache
+from .profiler import FactorProfiler
 from ..data import DataLoader
-from ..parallel import ParallelGroupBy
+from ..parallel import ParallelGroupBy, AlignedGroupBy, Rolling
 import pandas as pd
 import numpy as np
 import torch
@@ -25,6 +33,27 @@ class OHLCV:
     volume = DataFactor(inputs=('',))
 
 
+class FactorResult:
+    """
+    Result of `FactorEngine.run` when `output` is not 'dataframe'.
+    :param data: dict of column name to the result tensor (or np.ndarray if output='numpy').
+    :param mask: result of filter, same shape as data, None if no filter is set.
+    :param index: MultiIndex (date, asset) of each row of data, if output is 'tensor'/'numpy'.
+    :param dates: dates of axis 0 of data, if output is 'wide'.
+    :param assets: assets of axis 1 of data, if output is 'wide'.
+    """
+
+    def __init__(self, data: dict, mask, index=None, dates=None, assets=None):
+        self.data = data
+        self.mask = mask
+        self.index = index
+        self.dates = dates
+        self.assets = assets
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+
 class FactorEngine:
     """
     Engine for compute factors, used for back-testing and alpha-research both.
@@ -53,19 +82,78 @@ class FactorEngine:
         self._column_cache[data_column] = data
         return data
 
+    def share_rolling_(self, key: tuple) -> None:
+        """Register a consumer of the rolling input `key`, so it is built once in this run."""
+        with self._rolling_lock:
+            # consumers, rolling, cuda event of the build, threading event of the build
+            entry = self._rolling_cache.setdefault(key, [0, None, None, None])
+            entry[0] += 1
+
+    def rolling_(self, key: tuple, build: Callable[[], Rolling]) -> Rolling:
+        """
+        Return the rolling input `key` shared by consumers, `build()` it by the first one, and
+        release it after the last registered consumer got it. Only the first consumer of a key
+        builds, outside the lock, others of the same key wait for it.
+        """
+        with self._rolling_lock:
+            entry = self._rolling_cache.get(key)
+            builder = entry is not None and entry[3] is None
+            if builder:
+                entry[3] = threading.Event()
+        if entry is None:
+            return self._build_rolling(build)
+
+        if builder:
+            try:
+                entry[1] = self._build_rolling(build)
+                if entry[1].x.is_cuda:
+                    entry[2] = torch.cuda.current_stream().record_event()
+            finally:
+                entry[3].set()
+        else:
+            entry[3].wait()
+            if entry[2] is not None:
+                torch.cuda.current_stream().wait_event(entry[2])
+        ret = entry[1]
+
+        with self._rolling_lock:
+            entry[0] -= 1
+            if entry[0] <= 0 and self._rolling_cache.get(key) is entry:
+                del self._rolling_cache[key]
+        if ret is None:
+            # build failed by the first consumer
+            ret = self._build_rolling(build)
+        return ret
+
+    def _build_rolling(self, build: Callable[[], Rolling]) -> Rolling:
+        ret = build()
+        if self._memory_budget is not None:
+            ret.memory_budget = self._memory_budget
+        return ret
+
+    def profile_cache_hit_(self, factor: BaseFactor, data: torch.Tensor) -> None:
+        """Record that the result of `factor` is read from its cache, if profiling."""
+        if self._profiler is not None:
+            with self._profiler.record(type(factor).__name__, 'factor', cache_hit=True) as event:
+                event['output'] = data
+
     def column_to_parallel_groupby_(self, group_column: str, as_group_name=None):
         if as_group_name is None:
             as_group_name = group_column
         if as_group_name in self._groups:
             return
 
-        series = self._dataframe[group_column]
-        if series.dtype.name == 'category':
-            cat = series.cat.codes
-        else:
-            cat = series.values
-        keys = torch.tensor(cat, device=self._device, dtype=torch.int32)
-        self._groups[as_group_name] = ParallelGroupBy(keys)
+        with self._profile('groupby:' + as_group_name):
+            groupby = self._get_fast_groupby(group_column)
+            if groupby is None:
+                series = self._dataframe[group_column]
+                if series.dtype.name == 'category':
+                    cat = series.cat.codes
+                else:
+                    cat = series.values
+                keys = torch.tensor(cat, device=self._device, dtype=torch.int32)
+                groupby = ParallelGroupBy(keys)
+            self._groups[as_group_name] = groupby
 
     def create_tensor(self, group: str, dtype, values, nan_values) -> torch.Tensor:
         return self._groups[group].create(dtype, values, nan_values)
@@ -91,14 +179,85 @@ class FactorEngine:
 
     # private:
 
+    def _prepared_state(self) -> tuple:
+        """Everything except the date range, that affects the prepared data."""
+        static_assets = None
+        if isinstance(self._filter, StaticAssets):
+            static_assets = frozenset(self._filter.assets)
+        return self._align_by_time, static_assets
+
+    def _get_loader_version(self):
+        """`last_modified` of loader, None if the loader does not provide it."""
+        try:
+            return self._loader.last_modified
+        except NotImplementedError:
+            return None
+
+    def _slice_prepared(self, key: tuple, df: pd.DataFrame, start, end, max_backwards):
+        """Slice the prepared data of `key` range, if it contains the requested range."""
+        cached_start, cached_end, cached_backwards = key
+        dates = df.index.levels[0]
+        if not (dates[0] <= start <= dates[-1] and end <= cached_end):
+            return None
+        start_loc = dates.searchsorted(start)
+        # let loader handle the errors, such as no data in range
+        if start_loc < max_backwards or dates[start_loc] > end:
+            return None
+        df = df.loc[dates[start_loc - max_backwards]:end]
+        df.index = df.index.remove_unused_levels()
+        return df
+
     def _prepare_tensor(self, start, end, max_backwards):
         # Check cache, just in case, if use some ML techniques, engine may be called repeatedly
         # with same date range.
-        if start == self._last_load[0] and end == self._last_load[1] \
-                and max_backwards <= self._last_load[2]:
-            return
+        state = self._prepared_state()
+        prepared = [(key, entry) for key, entry in reversed(self._prepared.items())
+                    if entry['state'] == state]
+        for key, entry in prepared:
+            if start == key[0] and end == key[1] and max_backwards <= key[2]:
+                self._prepared.move_to_end(key)
+                self._dataframe = entry['dataframe']
+                self._groups = entry['groups']
+                self._column_cache = entry['column_cache']
+                self._grid_shape = self._get_grid_shape(self._dataframe)
+                self._last_load = list(key)
+                return
         self._groups = dict()
 
+        # Slice from prepared data which contains the range, align_by_time may produce
+        # different rows, so not supported.
+        df = None
+        if not self._align_by_time:
+            for key, entry in prepared:
+                df = self._slice_prepared(key, entry['dataframe'], start, end, max_backwards)
+                if df is not None:
+                    break
+
+        if df is None:
+            df = self._load_dataframe(start, end, max_backwards)
+            # read once per load, the prepared data of an old version of data source are dropped
+            version = self._get_loader_version()
+            for key in [k for k, e in self._prepared.items() if e['version'] != version]:
+                del self._prepared[key]
+        else:
+            version = entry['version']
+        self._set_dataframe(df)
+
+        # time group prepare
+        self.column_to_parallel_groupby_(self._loader.time_category, 'date')
+
+        self._last_load = [start, end, max_backwards]
+        key = tuple(self._last_load)
+        if version is None:
+            # unknown version of data source, such as live data, do not keep it
+            return
+        self._prepared[key] = dict(state=state, version=version, dataframe=self._dataframe,
+                                   groups=self._groups, column_cache=self._column_cache)
+        self._prepared.move_to_end(key)
+        while len(self._prepared) > self._prepared_capacity:
+            self._prepared.popitem(last=False)
+
+    def _load_dataframe(self, start, end, max_backwards) -> pd.DataFrame:
         # Get data
         df = self._loader.load(start, end, max_backwards).copy()
         df.index = df.index.remove_unused_levels()
@@ -116,29 +275,401 @@ class FactorEngine:
                 raise ValueError("The asset specified by StaticAssets filter, was not found in "
                                  "DataLoader.")
         if self._align_by_time:
-            # since pandas 0.23, MultiIndex reindex is slow, so using a alternative way here,
-            # but still very slow.
-            # df = df.reindex(pd.MultiIndex.from_product(df.index.levels))
-            df = df.unstack(level=1).stack(dropna=False)
+            df.index = df.index.remove_unused_levels()
+            df = DataLoader.reindex_product(df)
+        return df
+
+    def _set_dataframe(self, df):
         self._dataframe = df
+        self._groups = dict()
+        self._column_cache = {}
+        self._grid_shape = self._get_grid_shape(df)
 
         # asset group
-        cat = self._dataframe.index.get_level_values(1).codes
-        keys = torch.tensor(cat, device=self._device, dtype=torch.int32)
-        self._groups['asset'] = ParallelGroupBy(keys)
+        with self._profile('groupby:asset'):
+            groupby = self._get_fast_groupby('asset')
+            if groupby is None:
+                cat = self._dataframe.index.get_level_values(1).codes
+                keys = torch.tensor(cat, device=self._device, dtype=torch.int32)
+                groupby = ParallelGroupBy(keys)
+            self._groups['asset'] = groupby
 
-        # time group prepare
-        self.column_to_parallel_groupby_(self._loader.time_category, 'date')
+    @classmethod
+    def _get_grid_shape(cls, df: pd.DataFrame) -> Union[Tuple[int, int], None]:
+        """Return (dates, assets) if rows of df are a full grid in date major order."""
+        index = df.index
+        shape = (len(index.levels[0]), len(index.levels[1]))
+        if shape[0] * shape[1] != len(df):
+            return None
+        # by codes, levels may be not sorted by values, such as the categories of asset
+        date_codes, asset_codes = (np.asarray(codes).reshape(shape) for codes in index.codes)
+        if (date_codes == np.arange(shape[0])[:, None]).all() and \
+                (asset_codes == np.arange(shape[1])).all():
+            return shape
+        return None
 
-        self._column_cache = {}
-        self._last_load = [start, end, max_backwards]
+    def _get_fast_groupby(self, group: str):
+        """
+        Create group by without sorting keys, from the grid shape of data or the layout
+        provided by loader, None if not available.
+        """
+        if self._grid_shape is not None:
+            if group == 'asset':
+                return AlignedGroupBy(*self._grid_shape, True, self._device)
+            if self._loader is not None and group == self._loader.time_category:
+                series = self._dataframe[group]
+                if series.dtype.name == 'category':
+                    series = series.cat.codes
+                # time category must be same in each date row (nan of aligned rows is ok),
+                # and different between rows
+                values = series.values.reshape(self._grid_shape)
+                lo, hi = np.fmin.reduce(values, axis=1), np.fmax.reduce(values, axis=1)
+                if (lo == hi).all() and len(np.unique(lo)) == len(lo):
+                    return AlignedGroupBy(*self._grid_shape, False, self._device)
+
+        # filtered or aligned rows are not a date range of loader data
+        if self._loader is None or self._align_by_time or \
+                isinstance(self._filter, StaticAssets):
+            return None
+        layout = self._loader.groupby_layout(self._dataframe, group)
+        if layout is None:
+            return None
+        sorted_indices, counts = layout
+        return ParallelGroupBy.from_sorted(
+            torch.from_numpy(sorted_indices).to(self._device, non_blocking=True),
+            torch.from_numpy(counts).to(self._device, non_blocking=True))
+
+    @classmethod
+    def _merge_common_factors(cls, factors: dict, filter_: BaseFactor):
+        """
+        Merge structurally equal nodes in factors tree, so that each unique subtree will only be
+        computed once, such as `SMA(20)` created in different places.
+        Return merged factors and filter.
+        """
+        memo = {}
+        canonical = {}
+        visited = set()
+
+        def merge(factor):
+            if not isinstance(factor, BaseFactor):
+                return factor
+            factor = canonical.setdefault(factor.structure_key_(memo), factor)
+            if id(factor) in visited:
+                return factor
+            visited.add(id(factor))
+            # replace all upstream to the canonical one
+            for member, value in list(vars(factor).items()):
+                if isinstance(value, BaseFactor):
+                    setattr(factor, member, merge(value))
+            if isinstance(factor, CustomFactor) and factor.inputs:
+                inputs = tuple(merge(upstream) for upstream in factor.inputs)
+                if any(new is not old for new, old in zip(inputs, factor.inputs)):
+                    factor.inputs = inputs
+            return factor
+
+        factors = {col: merge(f) for col, f in factors.items()}
+        return factors, merge(filter_)
+
+    @classmethod
+    def _get_asset_frontier(cls, roots: list) -> list:
+        """
+        Find the factors which only depend on asset grouped factors (so can be computed by
+        asset shards), but are used by other groups or are roots.
+        """
+        local = {}
+
+        def is_local(node):
+            if id(node) not in local:
+                if isinstance(node, CustomFactor):
+                    local[id(node)] = node.groupby == 'asset' and \
+                                      all([is_local(up) for up in node.get_upstreams_()])
+                else:
+                    local[id(node)] = isinstance(node, DataFactor) and node.groupby == 'asset'
+            return local[id(node)]
 
-    def _compute_and_revert(self, f: BaseFactor, name) -> torch.Tensor:
+        frontier = {}
+        visited = set()
+
+        def visit(node):
+            if not isinstance(node, CustomFactor) or id(node) in visited:
+                return
+            visited.add(id(node))
+            if is_local(node):
+                return
+            for up in node.get_upstreams_():
+                if isinstance(up, CustomFactor) and is_local(up):
+                    frontier[id(up)] = up
+                else:
+                    visit(up)
+
+        for root in roots:
+            if isinstance(root, CustomFactor) and is_local(root):
+                frontier[id(root)] = root
+            else:
+                visit(root)
+        return list(frontier.values())
+
+    @staticmethod
+    def _compute_asset_shard(args) -> list:
+        df, nodes, device, memory_budget, start, end = args
+        engine = FactorEngine(None)
+        engine._device = device
+        engine._memory_budget = memory_budget
+        engine._set_dataframe(df)
+        for node in nodes:
+            node.pre_compute_(engine, start, end)
+        ret = [node.compute_(None) for node in nodes]
+        for node in nodes:
+            node.clean_up_()
+        return ret, engine._get_asset_group_codes()
+
+    def _compute_asset_shards(self, frontier: list, start, end) -> list:
+        """Compute `frontier` factors by asset shards, and merge into asset group tensors."""
+        # class level `inputs` is shared by instances and not copied by deepcopy, so pin it
+        visited = set()
+        stack = list(frontier)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, CustomFactor) and id(node) not in visited:
+                visited.add(id(node))
+                if 'inputs' not in vars(node):
+                    node.inputs = node.inputs
+                stack.extend(node.get_upstreams_())
+
+        # shard by the assets of asset group, the rows of shard engines may be in another order
+        codes = np.asarray(self._dataframe.index.get_level_values(1).codes)
+        assets = self._get_asset_group_codes()
+        if self._length_buckets:
+            lengths = np.bincount(codes)[assets]
+            shards = [assets[rows] for rows in self._get_length_buckets(lengths)]
+        else:
+            shards = np.array_split(assets, min(self._asset_shards, len(assets)))
+        jobs = [(self._dataframe[np.isin(codes, shard)], copy.deepcopy(frontier),
+                 self._device, self._memory_budget, start, end) for shard in shards]
+        pool = self._shard_pool
+        if self._device.type == 'cuda':
+            pool = ThreadPool
+        with pool(min(self._shard_core, len(jobs))) as p:
+            shard_results = p.map(FactorEngine._compute_asset_shard, jobs)
+
+        group_row = np.empty(assets.max() + 1, dtype=np.int64)
+        group_row[assets] = np.arange(len(assets))
+        shard_rows = [torch.from_numpy(group_row[shard_codes]).to(self._device)
+                      for _, shard_codes in shard_results]
+        merged = []
+        width = self._groups['asset'].data_shape[1]
+        for i in range(len(frontier)):
+            outs = [shard_ret[i].to(self._device) for shard_ret, _ in shard_results]
+            fill = np.nan if outs[0].is_floating_point() else 0
+            ret = outs[0].new_full((len(assets), width) + tuple(outs[0].shape[2:]), fill)
+            for rows, out in zip(shard_rows, outs):
+                ret[rows, :out.shape[1]] = out
+            merged.append(ret)
+        return merged
+
+    def _get_asset_group_codes(self) -> np.ndarray:
+        """Categorical codes of the assets, in the row order of asset group."""
+        index = self._dataframe.index
+        if isinstance(self._groups['asset'], AlignedGroupBy):
+            # rows of grid are in the order of level
+            return np.asarray(index.levels[1].codes)
+        return np.unique(index.get_level_values(1).codes)
+
+    @staticmethod
+    def _get_length_buckets(lengths: np.ndarray) -> list:
+        """Split groups into power of 2 size classes by their lengths, return group ids."""
+        size_class = np.ceil(np.log2(np.maximum(lengths, 1))).astype(int)
+        return [np.flatnonzero(size_class == c) for c in np.unique(size_class)]
+
+    def _plan_execution(self, roots: list) -> Tuple[list, int]:
+        """
+        Plan the evaluation order of the factor graph. Returns the CustomFactor nodes that need
+        to be computed before each root, and the estimated peak memory (bytes) of the plan.
+        Deeper subtrees are computed first, so their intermediates are released earlier.
+        """
+        heights = {}
+
+        def height(node):
+            if id(node) not in heights:
+                ups = node.get_upstreams_() if isinstance(node, CustomFactor) else ()
+                heights[id(node)] = 1 + max((height(up) for up in ups), default=0)
+            return heights[id(node)]
+
+        visited = set()
+        consumers = {}
+
+        preloaded = []
+
+        def visit(node, steps):
+            if not isinstance(node, CustomFactor) or id(node) in visited:
+                return
+            visited.add(id(node))
+            if node.is_cached_():
+                preloaded.append(node)
+                return
+            upstreams = node.get_upstreams_()
+            for up in upstreams:
+                consumers[id(up)] = consumers.get(id(up), 0) + 1
+            for up in sorted(upstreams, key=height, reverse=True):
+                visit(up, steps)
+            steps.append(node)
+
+        plan = []
+        for root in roots:
+            steps = []
+            visit(root, steps)
+            consumers[id(root)] = consumers.get(id(root), 0) + 1
+            plan.append(steps)
+
+        # simulate the execution, a result is released when its last consumer is computed.
+        itemsize = max([dt.itemsize for dt in self._dataframe.dtypes if dt.kind == 'f'] or [8])
+
+        def nbytes(node):
+            if not isinstance(node, CustomFactor) or node.groupby not in self._groups:
+                return 0  # data factors are columns of engine, always in memory
+            return int(np.prod(self._groups[node.groupby].data_shape)) * itemsize
+
+        def release(node):
+            consumers[id(node)] -= 1
+            return nbytes(node) if consumers[id(node)] == 0 else 0
+
+        live = peak = sum(map(nbytes, preloaded))
+        for root, steps in zip(roots, plan):
+            for node in steps:
+                upstreams = node.get_upstreams_()
+                # rolling window of inputs makes a padded copy
+                rolling = node.win > 1 and sum(map(nbytes, upstreams)) or 0
+                live += nbytes(node)
+                peak = max(peak, live + rolling)
+                live -= sum(map(release, upstreams))
+            # root is reverted and kept until all columns are done
+            live += self._dataframe.shape[0] * itemsize - release(root)
+            peak = max(peak, live)
+        return plan, peak
+
+    def _profile(self, name: str, category='stage', column=None):
+        if self._profiler is None:
+            return contextlib.nullcontext({})
+        return self._profiler.record(name, category, column)
+
+    def _schedule_compute(self, node: CustomFactor, stream, column) -> None:
+        with self._profile(type(node).__name__, 'factor', column) as event:
+            event['output'] = node.schedule_compute_(stream)
+
+    def _schedule_compute_parallel(self, steps: list, column) -> None:
+        """Compute planned steps in thread pool, the independent factors are computed at once."""
+        levels = {}
+        for node in steps:
+            levels[id(node)] = 1 + max([levels.get(id(up), 0) for up in node.get_upstreams_()]
+                                       or [0])
+        batches = [[] for _ in range(max(levels.values()))]
+        for node in steps:
+            batches[levels[id(node)] - 1].append(node)
+
+        with ThreadPool(self._cpu_workers) as p:
+            for batch in batches:
+                p.map(lambda x: self._schedule_compute(x, None, column), batch)
+
+    @classmethod
+    def _fuse_operators(cls, factors: dict, filter_: Union[BaseFactor, None]):
+        """
+        Collapse the chains of element-wise operator factors (such as `(a - b) / c > 0`)
+        into one FusedFactor, the intermediate results which used only by the chain are not
+        allocated anymore.
+        """
+        roots = list(factors.values()) + ([filter_] if filter_ else [])
+        consumers = {}
+        visited = set()
+
+        def count(node):
+            if not isinstance(node, CustomFactor) or id(node) in visited:
+                return
+            visited.add(id(node))
+            for up in node.get_upstreams_():
+                consumers[id(up)] = consumers.get(id(up), 0) + 1
+                count(up)
+
+        for root in roots:
+            consumers[id(root)] = consumers.get(id(root), 0) + 1
+            count(root)
+
+        def fusible(node):
+            return isinstance(node, CustomFactor) and '_fuse_expr' in vars(type(node)) \
+                and node.win == 1 and node._mask is None and node.inputs is not None \
+                and all([isinstance(up, BaseFactor) or
+                         (type(up) in (int, float) and np.isfinite(up)) for up in node.inputs])
+
+        def build(node, leaves, operators) -> str:
+            operators.append(node)
+            args = []
+            for up in node.inputs:
+                if not isinstance(up, BaseFactor):
+                    args.append(repr(up))
+                elif fusible(up) and consumers[id(up)] == 1 and up.groupby == node.groupby:
+                    args.append(build(up, leaves, operators))
+                else:
+                    ids = [id(leaf) for leaf in leaves]
+                    if id(up) not in ids:
+                        ids.append(id(up))
+                        leaves.append(up)
+                    args.append('x{}'.format(ids.index(id(up))))
+            return node._fuse_expr.format(*args)
+
+        replaced = {}
+
+        def fuse(factor):
+            if not isinstance(factor, CustomFactor):
+                return factor
+            if id(factor) in replaced:
+                return replaced[id(factor)]
+            replaced[id(factor)] = factor
+            if fusible(factor):
+                leaves, operators = [], []
+                expr = build(factor, leaves, operators)
+                if len(operators) > 1:
+                    try:
+                        get_fused_function(expr, len(leaves))
+                    except RuntimeError:
+                        pass
+                    else:
+                        fused = FusedFactor(leaves, expr)
+                        fused.groupby = factor.groupby
+                        replaced[id(factor)] = fused
+                        factor = fused
+            # replace all upstream to the fused one
+            for member, value in list(vars(factor).items()):
+                if isinstance(value, BaseFactor):
+                    setattr(factor, member, fuse(value))
+            if factor.inputs:
+                inputs = tuple(fuse(up) for up in factor.inputs)
+                if any(new is not old for new, old in zip(inputs, factor.inputs)):
+                    factor.inputs = inputs
+            return factor
+
+        factors = {col: fuse(f) for col, f in factors.items()}
+        return factors, filter_ and fuse(filter_)
+
+    def _compute_and_revert(self, f: BaseFactor, name, steps=()) -> torch.Tensor:
         stream = None
         if self._device.type == 'cuda':
             stream = torch.cuda.current_stream()
-        data = f.compute_(stream)
-        return self._groups[f.groupby].revert(data, name)
+        if steps and steps[-1] is f:
+            # root is computed below, not scheduled then read from cache again
+            steps = steps[:-1]
+        if self._cpu_workers and stream is None and len(steps) > 1:
+            self._schedule_compute_parallel(steps, name)
+        else:
+            for node in steps:
+                self._schedule_compute(node, stream, name)
+        if isinstance(f, CustomFactor) and f.is_cached_():
+            # cache hit is recorded by `compute_`
+            data = f.compute_(stream)
+        else:
+            with self._profile(type(f).__name__, 'factor', name) as event:
+                data = event['output'] = f.compute_(stream)
+        with self._profile('revert', column=name) as event:
+            event['output'] = self._groups[f.groupby].revert(data, name)
+        return event['output']
 
     # public:
 
@@ -147,16 +678,51 @@ class FactorEngine:
         self._dataframe = None
         self._groups = dict()
         self._last_load = [None, None, None]
+        self._prepared = OrderedDict()
+        self._prepared_capacity = 2
         self._column_cache = {}
+        self._rolling_cache = {}
+        self._rolling_lock = threading.Lock()
+        self._grid_shape = None
         self._factors = {}
         self._filter = None
         self._device = torch.device('cpu')
         self._align_by_time = False
+        self._incremental = False
+        self._last_result = None
+        self._result_cache = None
+        self._planned_peak_memory = 0
+        self._chunk_size = None
+        self._memory_budget = None
+        self._asset_shards = None
+        self._shard_pool = ThreadPool
+        self._shard_core = cpu_count()
+        self._length_buckets = False
+        self._cpu_workers = None
+        self._operator_fusion = False
+        self._profiler = None
 
     @property
     def device(self):
         return self._device
 
+    @property
+    def planned_peak_memory(self):
+        """
+        Estimated peak memory (bytes) of factor results in the last run (or `plan`), planned
+        before computing.
+        Data columns of the loader are not included.
+        """
+        return self._planned_peak_memory
+
+    @property
+    def profiler(self) -> Union[FactorProfiler, None]:
+        """
+        Profiling records of the last run, use `profiler.to_dataframe()` or
+        `profiler.to_chrome_trace()` to view. None if profiling is not enabled.
+        """
+        return self._profiler
+
     def set_align_by_time(self, enable: bool):
         """
         If `enable` is `True`, df index will be the product of 'date' and 'asset'.
@@ -164,6 +730,113 @@ class FactorEngine:
         """
         self._align_by_time = enable
 
+    def set_result_cache(self, path: Union[str, None], max_bytes: int = 1024 ** 3):
+        """
+        Cache the result of each factor to `path` on disk, when the same factor is computed
+        again with the same data and date range, the result is read from disk without computing.
+        The key of cache is the structure of the factor tree (including the code of factor
+        classes), `loader.fingerprint` and the date range. Results of loaders without
+        `last_modified` are not cached. Set `path` to None to disable.
+        :param path: directory to save cache files.
+        :param max_bytes: when the total size exceeds, the least recently used files are removed.
+        """
+        if path is None:
+            self._result_cache = None
+        else:
+            self._result_cache = FactorResultCache(path, max_bytes)
+
+    def set_chunk_size(self, bars: Union[int, None]):
+        """
+        Split the date range of `run` into chunks of `bars` trading bars, each chunk is loaded
+        with its `max_backwards` of history and computed separately, so the memory usage depends
+        on the chunk size rather than the whole date range. The result is identical to a
+        single run. After `run`, `dataframe_` only contains the data of the last chunk.
+        Set `bars` to None to disable. Not used in incremental mode.
+        """
+        assert bars is None or bars > 0
+        self._chunk_size = bars
+
+    def set_memory_budget(self, max_bytes: Union[int, None]):
+        """
+        Max memory (bytes) used by each chunk of rolling window calculation (`Rolling.agg`), the
+        rows of factor data are split into chunks by the estimated memory of op, and computed
+        one by one. Smaller budget uses less memory but more kernel launches.
+        Set to None to use the default of `Rolling.memory_budget`.
+        """
+        assert max_bytes is None or max_bytes > 0
+        self._memory_budget = max_bytes
+
+    def set_asset_shards(self, shards: Union[int, None], multiprocess=False, core=None):
+        """
+        Split assets into `shards`, the factors that only depend on asset grouped factors are
+        computed separately by each shard in a thread/process pool, and merged before the
+        factors grouped by date (such as rank). Useful for very wide universes.
+        Asset grouped factors must compute each asset independently.
+        :param shards: number of shards, None to disable.
+        :param multiprocess: use process pool instead of thread pool, factor classes must be
+                             picklable. Not used in cuda device.
+        :param core: pool size, default is cpu count.
+        """
+        self._asset_shards = shards
+        self._shard_pool = Pool if multiprocess else ThreadPool
+        self._shard_core = core or cpu_count()
+
+    def set_length_buckets(self, enable: bool):
+        """
+        Like `set_asset_shards`, but shard assets by their number of bars, in power of 2 size
+        classes. Each shard is a dense tensor only as wide as its longest asset, so short-lived
+        assets are not padded to the longest one, saving the memory and computation of Rolling
+        on wide universe with many short histories. Pool settings are from `set_asset_shards`.
+        """
+        self._length_buckets = enable
+
+    def set_cpu_workers(self, workers: Union[int, None]):
+        """
+        When running on cpu, compute independent factors (such as the inputs of a factor) in a
+        thread pool of `workers` threads, useful when the data is too small to saturate all
+        cores by torch itself. None to disable.
+        """
+        self._cpu_workers = workers if workers and workers > 1 else None
+
+    def set_operator_fusion(self, enable: bool):
+        """
+        If `enable` is `True`, the chains of element-wise operator factors, such as
+        `(ma5 - ma20) / std20 > 0`, are fused into one TorchScript function, which reduces the
+        allocation of intermediate results. Note that the factors using the chain will be
+        linked to the fused factor.
+        """
+        self._operator_fusion = enable
+
+    def set_profiling(self, enable: bool):
+        """
+        If `enable` is `True`, record the time and memory of each factor and each stage
+        (loading data, group by, revert, assembly of DataFrame) of `run`, see `profiler`.
+        """
+        self._profiler = FactorProfiler(self._device) if enable else None
+
+    def set_prepared_cache_size(self, size: int):
+        """
+        How many prepared data (loaded data, group by and tensors) of different date ranges are
+        kept, so alternately running different ranges (such as train and test) does not reload.
+        A range contained by a kept range is sliced from it instead of loading.
+        Kept data are dropped when `loader.last_modified` changes, which is checked on loading,
+        data of loaders without `last_modified` are not kept.
+        """
+        assert size > 0
+        self._prepared_capacity = size
+        while len(self._prepared) > size:
+            self._prepared.popitem(last=False)
+
+    def set_incremental(self, enable: bool):
+        """
+        If `enable` is `True`, `run` will reuse the result of the last run, only compute the new
+        bars after the last `end`, useful when calling `run` every bar with a moving window.
+        Only the factors using a fixed window (all built-in rolling factors) are supported, and
+        the data before the last `end` must be unchanged.
+        """
+        self._incremental = enable
+        self._last_result = None
+
     def add(self,
             factor: Union[Iterable[BaseFactor], BaseFactor],
             name: Union[Iterable[str], str],
@@ -203,28 +876,38 @@ class FactorEngine:
     def to_cuda(self) -> None:
         self._device = torch.device('cuda')
         self._last_load = [None, None, None]
+        self._prepared.clear()
+        if self._profiler is not None:
+            self._profiler.device = self._device
 
     def to_cpu(self) -> None:
         self._device = torch.device('cpu')
         self._last_load = [None, None, None]
+        self._prepared.clear()
+        if self._profiler is not None:
+            self._profiler.device = self._device
 
     def test_lookahead_bias(self, start, end):
         """Check all factors, if there are look-ahead bias"""
         start, end = pd.to_datetime(start, utc=True), pd.to_datetime(end, utc=True)
         # get results
-        df_expected = self.run(start, end)
+        self._bind_ohlcv()
+        df_expected = self._run_once(start, end, True)
         # modify future data
         mid = int(self._dataframe[start:].shape[0] / 2)
         mid_time = self._dataframe[start:].index[mid][0]
         length = self._dataframe.loc[mid_time:].shape[0]
         for c in self._loader.ohlcv:
             self._dataframe.loc[mid_time:, c] = np.random.randn(length)
-        self._column_cache = {}
-        # check if results are consistent
-        df = self.run(start, end)
+        self._column_cache.clear()
+        # check if results are consistent, disk cache does not know the data changed
+        result_cache, self._result_cache = self._result_cache, None
+        df = self._run_once(start, end, True)
+        self._result_cache = result_cache
         # clean
         self._column_cache = {}
         self._last_load = [None, None, None]
+        self._prepared.clear()
 
         try:
             pd.testing.assert_frame_equal(df_expected[:mid_time], df[:mid_time])
@@ -232,23 +915,7 @@ class FactorEngine:
             raise RuntimeError('A look-ahead bias was detected, please check your factors code')
         return 'No assertion raised.'
 
-    def run(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp],
-            delay_factor=True) -> pd.DataFrame:
-        """
-        Compute factors and filters, return a df contains all.
-        """
-        if len(self._factors) == 0:
-            raise ValueError('Please add at least one factor to engine, then run again.')
-
-        if not delay_factor:
-            for c, f in self._factors.items():
-                if f.include_close_data():
-                    warnings.warn("Warning!! delay_factor is set to False, "
-                                  "but {} factor uses data that is only available "
-                                  "after the market is closed.".format(c),
-                                  RuntimeWarning)
-
-        start, end = pd.to_datetime(start, utc=True), pd.to_datetime(end, utc=True)
+    def _bind_ohlcv(self):
         # make columns to data factors.
         if self._loader.ohlcv is not None:
             OHLCV.open.inputs = (self._loader.ohlcv[0], self._loader.adjustment_multipliers[0])
@@ -257,54 +924,359 @@ class FactorEngine:
             OHLCV.close.inputs = (self._loader.ohlcv[3], self._loader.adjustment_multipliers[0])
             OHLCV.volume.inputs = (self._loader.ohlcv[4], self._loader.adjustment_multipliers[1])
 
-        # get factor
+    def _build_factor_tree(self, delay_factor) -> Tuple[dict, BaseFactor, int]:
+        """Factors and filter to compute, and the backwards of data they require."""
         filter_ = self._filter
         if filter_ and delay_factor:
             filter_ = filter_.shift(1)
         factors = {c: delay_factor and f.shift(1) or f for c, f in self._factors.items()}
+        # same subtree only compute once
+        factors, filter_ = self._merge_common_factors(factors, filter_)
+        if self._operator_fusion:
+            factors, filter_ = self._fuse_operators(factors, filter_)
 
         # Calculate data that requires backwards in tree
         max_backwards = max([f.get_total_backwards_() for f in factors.values()])
         if filter_:
             max_backwards = max(max_backwards, filter_.get_total_backwards_())
+        return factors, filter_, max_backwards
+
+    def _get_asset_backwards(self, history: dict, origin: pd.Timestamp, start: pd.Timestamp,
+                             max_backwards: int) -> int:
+        """
+        How many dates before `start` need to be loaded, so that every asset has the same
+        history as a run from `origin`, assets may have fewer bars than dates.
+        `history` is the recent bars of each asset, see `_update_asset_history`.
+        """
+        if max_backwards == 0 or not history:
+            return max_backwards
+        calendar = history['calendar']
+        p = calendar.searchsorted(start)
+        date_pos = calendar.searchsorted(history['dates'])
+        asset = history['assets']
+        # a run from `origin` has no bars before `max_backwards` dates of `origin`
+        hist = (date_pos < p) & (date_pos >= calendar.searchsorted(origin) - max_backwards)
+        # only assets with bars in recent `max_backwards` dates are considered
+        recent = np.unique(asset[hist & (date_pos >= p - max_backwards)])
+        hist &= np.isin(asset, recent)
+        if not hist.any():
+            return max_backwards
+        # the last `max_backwards` bars of each asset are needed
+        date_pos = date_pos[hist]
+        nth_last = pd.Series(date_pos).groupby(asset[hist]).cumcount(ascending=False).values
+        first = date_pos[nth_last < max_backwards].min()
+        return int(max(max_backwards, p - first))
+
+    @staticmethod
+    def _update_asset_history(history: dict, index: pd.MultiIndex,
+                              max_backwards: int) -> None:
+        """
+        Append the bars of `index` to `history`, only the last `max_backwards` + 1 bars of
+        each asset are kept (+1 for the bar on next start date), so the size is bounded by
+        assets.
+        """
+        dates = index.get_level_values(0)
+        assets = np.asarray(index.get_level_values(1))
+        calendar = index.levels[0]
+        if history:
+            new = dates > history['calendar'][-1]
+            dates = history['dates'].append(dates[new])
+            assets = np.concatenate([history['assets'], assets[new]])
+            calendar = history['calendar'].append(calendar[calendar > history['calendar'][-1]])
+        nth_last = pd.Series(assets).groupby(assets).cumcount(ascending=False).values
+        keep = nth_last <= max_backwards
+        dates, assets = dates[keep], assets[keep]
+        if len(dates) > 0:
+            calendar = calendar[calendar >= dates.min()]
+        history.update(dates=dates, assets=assets, calendar=calendar)
+
+    def _run_once(self, start: pd.Timestamp, end: pd.Timestamp, delay_factor,
+                  history: dict = None, origin: pd.Timestamp = None, output='dataframe'
+                  ) -> Union[pd.DataFrame, FactorResult]:
+        """
+        `history` is updated with the loaded bars of each asset, if `origin` is also given,
+        uses it to load the same history as a run from `origin`.
+        """
+        factors, filter_, max_backwards = self._build_factor_tree(delay_factor)
+        asset_backwards = max_backwards
+        if origin is not None and origin < start:
+            asset_backwards = self._get_asset_backwards(history, origin, start, max_backwards)
         # Get data
-        self._prepare_tensor(start, end, max_backwards)
+        with self._profile('prepare_tensor'):
+            self._prepare_tensor(start, end, asset_backwards)
+        if history is not None:
+            self._update_asset_history(history, self._dataframe.index, max_backwards)
+
+        # load results from disk cache, factors hit cache no need to compute, key `None` is filter
+        cached, digests = {}, {}
+        if self._result_cache is not None:
+            digests = self._get_cache_digests(factors, filter_, start, end, max_backwards)
+            for col, digest in digests.items():
+                data = self._result_cache.get(digest, self._dataframe.shape[0])
+                if data is not None:
+                    cached[col] = data
+        columns = list(factors)
+        factors = {c: f for c, f in factors.items() if c not in cached}
+        has_filter = filter_ is not None
+        if None in cached:
+            filter_ = None
 
         # clean up before start / may be keyboard interrupt
         if filter_:
             filter_.clean_up_()
         for f in factors.values():
             f.clean_up_()
+        self._rolling_cache.clear()
+
+        # compute asset grouped factors by asset shards
+        roots = list(factors.values()) + ([filter_] if filter_ else [])
+        frontier, shard_results = [], []
+        if (self._asset_shards and self._asset_shards > 1) or self._length_buckets:
+            frontier = self._get_asset_frontier(roots)
+            if frontier:
+                with self._profile('asset_shards'):
+                    shard_results = self._compute_asset_shards(frontier, start, end)
 
         # ready to compute
         if filter_:
             filter_.pre_compute_(self, start, end)
         for f in factors.values():
             f.pre_compute_(self, start, end)
+        stream = torch.cuda.current_stream() if self._device.type == 'cuda' else None
+        for f, data in zip(frontier, shard_results):
+            f.inject_cache_(data, stream)
+
+        # plan the order of computation, so intermediate results can be released early
+        plan, self._planned_peak_memory = self._plan_execution(roots)
 
         # schedule possible gpu work first
-        results = {col: self._compute_and_revert(fct, col) for col, fct in factors.items()}
-        shift_mask = None
+        results = {col: self._compute_and_revert(fct, col, steps)
+                   for (col, fct), steps in zip(factors.items(), plan)}
         if filter_:
-            shift_mask = self._compute_and_revert(filter_, 'filter')
+            results[None] = self._compute_and_revert(filter_, 'filter', plan[-1])
         # do cpu work and synchronize will automatically done by torch
-        ret = pd.DataFrame(index=self._dataframe.index.copy())
-        ret = ret.assign(**{col: t.cpu().numpy() for col, t in results.items()})
-        if filter_:
-            ret = ret[shift_mask.cpu().numpy()]
+        with self._profile('assembly'):
+            if self._result_cache is not None:
+                for col, data in results.items():
+                    self._result_cache.put(digests[col], data.cpu().numpy())
+            if output == 'dataframe':
+                results = {col: t.cpu().numpy() for col, t in results.items()}
+                results.update(cached)
+                ret = pd.DataFrame(index=self._dataframe.index.copy())
+                ret = ret.assign(**{col: results[col] for col in columns})
+                if has_filter:
+                    ret = ret[results[None]]
+            else:
+                results.update(cached)
+                ret = self._assemble_arrays(results, columns, start, delay_factor, output)
 
         # do clean up again
         if filter_:
             filter_.clean_up_()
         for f in factors.values():
             f.clean_up_()
+        self._rolling_cache.clear()
+
+        if output != 'dataframe':
+            return ret
 
         index = ret.index.levels[0]
         start = index.get_loc(start, 'bfill')
         if delay_factor:
             start += 1
+        if start >= len(index):
+            return ret.iloc[:0]
         return ret.loc[index[start]:]
 
+    def _assemble_arrays(self, results: dict, columns: list, start: pd.Timestamp, delay_factor,
+                         output: str) -> FactorResult:
+        """Assemble the results without pandas, key `None` of results is filter"""
+        index = self._dataframe.index
+        dates = index.levels[0]
+        first = dates.get_loc(start, 'bfill') + (1 if delay_factor else 0)
+        date_codes = index.codes[0]
+        row_start = int(np.searchsorted(date_codes, first))
+
+        def to_device(data):
+            if isinstance(data, np.ndarray):
+                return torch.from_numpy(data).to(self._device)
+            return data
+
+        if output == 'wide':
+            date_codes = date_codes[row_start:].astype(np.int64) - first
+            date_codes = torch.from_numpy(date_codes).to(self._device)
+            asset_codes = index.codes[1][row_start:].astype(np.int64)
+            asset_codes = torch.from_numpy(asset_codes).to(self._device)
+            shape = (max(len(dates) - first, 0), len(index.levels[1]))
+
+            def to_wide(data):
+                data = to_device(data)
+                fill = np.nan if data.is_floating_point() else 0
+                ret = data.new_full(shape + tuple(data.shape[1:]), fill)
+                ret[date_codes, asset_codes] = data[row_start:]
+                return ret
+
+            data = {col: to_wide(results[col]) for col in columns}
+            mask = to_wide(results[None]) if None in results else None
+            return FactorResult(data, mask, dates=dates[first:], assets=index.levels[1])
+        else:
+            convert = to_device
+            if output == 'numpy':
+                def convert(x):
+                    return x if isinstance(x, np.ndarray) else x.cpu().numpy()
+            data = {col: convert(results[col])[row_start:] for col in columns}
+            mask = convert(results[None])[row_start:] if None in results else None
+            return FactorResult(data, mask, index=index[row_start:])
+
+    def _get_cache_digests(self, factors, filter_, start, end, max_backwards) -> dict:
+        """
+        Disk cache file name of each factor, key `None` is filter, all None if the version of
+        loader data is unknown.
+        """
+        if self._get_loader_version() is None:
+            return {col: None for col in list(factors) + ([None] if filter_ is not None else [])}
+        memo = {}
+        static_assets = None
+        if isinstance(self._filter, StaticAssets):
+            static_assets = self._filter.structure_key_(memo)
+        # everything that affects the row layout of the prepared data
+        data_key = (self._loader.fingerprint, str(start), str(end), max_backwards,
+                    self._device.type, self._align_by_time, static_assets)
+        digests = {col: FactorResultCache.digest(f.structure_key_(memo), data_key)
+                   for col, f in factors.items()}
+        if filter_ is not None:
+            digests[None] = FactorResultCache.digest(filter_.structure_key_(memo), data_key)
+        return digests
+
+    def _run_signature(self, delay_factor) -> tuple:
+        """Key of everything that affects the result of a run, except the date range."""
+        memo = {}
+        filter_key = self._filter and self._filter.structure_key_(memo)
+        factor_keys = tuple((c, f.structure_key_(memo)) for c, f in self._factors.items())
+        return delay_factor, self._device, self._align_by_time, factor_keys, filter_key
+
+    def _run_after(self, last: pd.Timestamp, end: pd.Timestamp, delay_factor,
+                   origin: pd.Timestamp, history: dict) -> pd.DataFrame:
+        """Only compute the bars after `last` date, same result as a run from `origin`"""
+        ret = self._run_once(last, end, delay_factor, history, origin)
+        if not delay_factor:
+            ret = ret.loc[ret.index.get_level_values(0) > last]
+        return ret
+
+    def _run_chunked(self, start: pd.Timestamp, end: pd.Timestamp,
+                     delay_factor) -> pd.DataFrame:
+        dates = self._loader.load(start, end, 0).index.get_level_values(0).unique()
+        # chunk boundaries, each chunk computes the bars after the last date of previous chunk
+        lasts = dates[self._chunk_size - 1:-1:self._chunk_size]
+        if len(lasts) == 0:
+            return self._run_once(start, end, delay_factor)
+        # recent bars of each asset carried between chunks, so each chunk loads only its own
+        # dates and the overlap
+        history = {}
+        chunks = [self._run_once(start, lasts[0], delay_factor, history)]
+        for last, chunk_end in zip(lasts, list(lasts[1:]) + [end]):
+            chunks.append(self._run_after(last, chunk_end, delay_factor, start, history))
+        return pd.concat(chunks)
+
+    def _run_incremental(self, start: pd.Timestamp, end: pd.Timestamp,
+                         delay_factor) -> pd.DataFrame:
+        signature = self._run_signature(delay_factor)
+        last = self._last_result
+        if last is None or last['signature'] != signature \
+                or not (last['start'] <= start <= last['dates'][-1] <= end):
+            history = {}
+            ret = self._run_once(start, end, delay_factor, history)
+            dates = self._dataframe.index.levels[0]
+        else:
+            dates = last['dates']
+            history = last['history']
+            ret = last['result']
+            if delay_factor:
+                # same as `run`, the first bar is used for delay
+                first = dates[dates.searchsorted(start)]
+                ret = ret.loc[ret.index.get_level_values(0) > first]
+            else:
+                ret = ret.loc[start:]
+            if end > dates[-1]:
+                tail = self._run_after(dates[-1], end, delay_factor, start, history)
+                ret = pd.concat([ret, tail])
+                new_dates = self._dataframe.index.levels[0]
+                dates = dates.append(new_dates[new_dates > dates[-1]])
+        # recent bars of each asset are kept, so the next tail loads only the new bars
+        self._last_result = dict(signature=signature, start=start, result=ret,
+                                 dates=dates[dates.searchsorted(start):], history=history)
+        return ret
+
+    def run(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp],
+            delay_factor=True, output='dataframe') -> Union[pd.DataFrame, FactorResult]:
+        """
+        Compute factors and filters, return a df contains all.
+        :param output: 'dataframe': return a df contains all factors, filtered by filter.
+            Other values return `FactorResult` without any pandas work, filter is returned
+            as `mask` rather than applied:
+            'tensor': 1-D tensors on engine device, each element is a row of `index`.
+            'numpy': same as 'tensor' but np.ndarray.
+            'wide': dense tensors on engine device, shape (len(dates), len(assets)), NaN if
+            the asset has no data on that date.
+        """
+        if len(self._factors) == 0:
+            raise ValueError('Please add at least one factor to engine, then run again.')
+        if output not in ('dataframe', 'tensor', 'numpy', 'wide'):
+            raise ValueError("`output` must be 'dataframe', 'tensor', 'numpy' or 'wide'.")
+        if output != 'dataframe' and (self._incremental or self._chunk_size):
+            raise ValueError("Only output='dataframe' is supported in incremental or "
+                             "chunked mode.")
+
+        if not delay_factor:
+            for c, f in self._factors.items():
+                if f.include_close_data():
+                    warnings.warn("Warning!! delay_factor is set to False, "
+                                  "but {} factor uses data that is only available "
+                                  "after the market is closed.".format(c),
+                                  RuntimeWarning)
+
+        start, end = pd.to_datetime(start, utc=True), pd.to_datetime(end, utc=True)
+        self._bind_ohlcv()
+        if self._profiler is not None:
+            self._profiler.clear()
+        if self._incremental:
+            return self._run_incremental(start, end, delay_factor)
+        elif self._chunk_size:
+            return self._run_chunked(start, end, delay_factor)
+        else:
+            return self._run_once(start, end, delay_factor, output=output)
+
+    def plan(self, start: Union[str, pd.Timestamp], end: Union[str, pd.Timestamp],
+             delay_factor=True) -> Tuple[dict, int]:
+        """
+        Plan a run without computing, only the data is loaded (and reused by the next run).
+        Return the steps of each column (factors in the order of computing, key `None` is
+        filter), and the estimated peak memory (bytes) of factor results, same as
+        `planned_peak_memory` after `run`. Results computed by asset shards are not considered.
+        """
+        if len(self._factors) == 0:
+            raise ValueError('Please add at least one factor to engine, then run again.')
+        start, end = pd.to_datetime(start, utc=True), pd.to_datetime(end, utc=True)
+        self._bind_ohlcv()
+        factors, filter_, max_backwards = self._build_factor_tree(delay_factor)
+        self._prepare_tensor(start, end, max_backwards)
+
+        roots = list(factors.values()) + ([filter_] if filter_ else [])
+        for f in roots:
+            f.clean_up_()
+        try:
+            if filter_:
+                filter_.pre_compute_(self, start, end)
+            for f in factors.values():
+                f.pre_compute_(self, start, end)
+            plan, self._planned_peak_memory = self._plan_execution(roots)
+        finally:
+            for f in roots:
+                f.clean_up_()
+            self._rolling_cache.clear()
+        columns = list(factors) + ([None] if filter_ else [])
+        return dict(zip(columns, plan)), self._planned_peak_memory
+
     def get_factors_raw_value(self):
         stream = None
         if self._device.type == 'cuda':
@@ -6,16 +6,49 @@
 """
 from abc import ABC
 from typing import Optional, Sequence, Union
+import threading
 import numpy as np
 import torch
-from ..parallel import nansum, nanmean, nanstd, Rolling
+from ..parallel import nansum, nanmean, nanstd, Rolling, dense_group_ids, segment_count, \
+    segment_nanmean, segment_nanstd, segment_sort, segment_rank
 from .plotting import plot_factor_diagram
 
 
+_ref_count_lock = threading.Lock()
+
+
+def _param_key(value, memo: dict):
+    """Convert a factor parameter to a hashable value, equal parameters get equal keys."""
+    if isinstance(value, BaseFactor):
+        return value.structure_key_(memo)
+    elif value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return type(value).__name__, value
+    elif isinstance(value, (tuple, list)):
+        return 'seq', tuple(_param_key(v, memo) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return 'set', tuple(sorted((_param_key(v, memo) for v in value), key=repr))
+    elif isinstance(value, dict):
+        items = ((_param_key(k, memo), _param_key(v, memo)) for k, v in value.items())
+        return 'dict', tuple(sorted(items, key=repr))
+    elif isinstance(value, torch.Tensor):
+        value = value.cpu().numpy()
+        return 'array', str(value.dtype), value.shape, value.tobytes()
+    elif isinstance(value, np.ndarray):
+        return 'array', str(value.dtype), value.shape, value.tobytes()
+    elif isinstance(value, np.generic):
+        return type(value).__name__, value.item()
+    elif isinstance(value, type):
+        return 'type', value
+    else:
+        # unknown object, only equal to itself
+        return '__id__', id(value)
+
+
 class BaseFactor:
     """ Basic factor class, only helper methods """
     groupby = 'asset'  # indicates inputs and return value of this factor are grouped by what
     _engine = None
+    _runtime_members = ('_engine',)  # members that not affect the result, excluded from key
 
     # --------------- overload ops ---------------
 
@@ -86,40 +119,50 @@ class BaseFactor:
     def bottom(self, n, mask: 'BaseFactor' = None):
         return self.rank(ascending=True, mask=mask) <= n
 
-    def rank(self, ascending=True, mask: 'BaseFactor' = None):
-        factor = RankFactor(inputs=(self,))
+    def _inputs_with_group(self, groupby: Union[str, dict, None]) -> tuple:
+        if groupby is None:
+            return self,
+        elif isinstance(groupby, (str, dict)):
+            from .datafactor import GroupIdFactor
+            return self, GroupIdFactor(groupby)
+        else:
+            raise ValueError('`groupby` must be a column name or a dict.')
+
+    def rank(self, ascending=True, mask: 'BaseFactor' = None,
+             groupby: Union[str, dict] = None):
+        """ `groupby`: rank within each group of each date, see `demean`. """
+        factor = RankFactor(inputs=self._inputs_with_group(groupby))
         # factor.method = method
         factor.ascending = ascending
         factor.set_mask(mask)
         return factor
 
-    def zscore(self, axis_asset=False, mask: 'BaseFactor' = None):
+    def zscore(self, axis_asset=False, mask: 'BaseFactor' = None,
+               groupby: Union[str, dict] = None):
+        """ `groupby`: zscore within each group of each date, see `demean`. """
         if axis_asset:
+            if groupby is not None:
+                raise ValueError('`groupby` is not supported when `axis_asset=True`.')
             factor = AssetZScoreFactor(inputs=(self,))
         else:
-            factor = ZScoreFactor(inputs=(self,))
+            factor = ZScoreFactor(inputs=self._inputs_with_group(groupby))
         factor.set_mask(mask)
         return factor
 
     def demean(self, groupby: Union[str, dict] = None, mask: 'BaseFactor' = None):
         """
+        Demean within each group of each date.
         Set `groupby` to the name of a column, like 'sector'.
-        `groupby` also can be a dictionary like groupby={'name': group_id}, `group_id` must > 0
-        dict groupby will interrupt the parallelism of cuda, it is recommended to add group key to
-        the Dataloader as a column, or use it only in the last step.
+        `groupby` also can be a dictionary like groupby={'name': group}, assets not in the dict
+        are in the same group.
         """
-        factor = DemeanFactor(inputs=(self,))
-        if isinstance(groupby, str):
-            factor.groupby = groupby
-        elif isinstance(groupby, dict):
-            factor.group_dict = groupby
-        elif groupby is not None:
-            raise ValueError()
+        factor = DemeanFactor(inputs=self._inputs_with_group(groupby))
         factor.set_mask(mask)
         return factor
 
-    def quantile(self, bins=5, mask: 'BaseFactor' = None):
-        factor = QuantileFactor(inputs=(self,))
+    def quantile(self, bins=5, mask: 'BaseFactor' = None, groupby: Union[str, dict] = None):
+        """ `groupby`: quantile within each group of each date, see `demean`. """
+        factor = QuantileFactor(inputs=self._inputs_with_group(groupby))
         factor.bins = bins
         factor.set_mask(mask)
         return factor
@@ -165,6 +208,24 @@ class BaseFactor:
     def get_total_backwards_(self) -> int:
         raise NotImplementedError("abstractmethod")
 
+    def _get_params(self) -> dict:
+        """Return all members that determine the output of this factor"""
+        return {k: v for k, v in vars(self).items() if k not in self._runtime_members}
+
+    def structure_key_(self, memo: dict) -> tuple:
+        """
+        Return a hashable key of the computation tree of this factor, factors with equal key
+        will produce the same result, so engine only needs to compute one of them.
+        `memo` is a dict for caching keys of the nodes that have already been visited.
+        """
+        key = memo.get(id(self))
+        if key is None:
+            params = self._get_params()
+            key = (type(self),
+                   tuple((k, _param_key(params[k], memo)) for k in sorted(params)))
+            memo[id(self)] = key
+        return key
+
     def include_close_data(self) -> bool:
         return False
 
@@ -192,12 +253,14 @@ class CustomFactor(BaseFactor):
     win = 1          # determine include how many previous data
     inputs = None    # any values in `inputs` list will pass to `compute` function by order
     _min_win = None  # assert when `win` less than `_min_win`, prevent user error.
+    _fuse_expr = None  # expression template of element-wise operator, for operator fusion
 
     # internal member variables
     _cache = None
     _ref_count = 0
     _cache_stream = None
     _mask = None
+    _runtime_members = BaseFactor._runtime_members + ('_cache', '_ref_count', '_cache_stream')
 
     def __init__(self, win: Optional[int] = None, inputs: Optional[Sequence[BaseFactor]] = None):
         """
@@ -234,6 +297,12 @@ class CustomFactor(BaseFactor):
         else:
             return backwards
 
+    def _get_params(self) -> dict:
+        params = super()._get_params()
+        # class level default values are also params
+        params.update(win=self.win, inputs=self.inputs, _mask=self._mask)
+        return params
+
     def include_close_data(self) -> bool:
         ret = super().include_close_data()
         if self.inputs:
@@ -275,36 +344,48 @@ class CustomFactor(BaseFactor):
             for upstream in self.inputs:
                 if isinstance(upstream, BaseFactor):
                     upstream.pre_compute_(engine, start, end)
+                    if self.win > 1:
+                        engine.share_rolling_(self._rolling_key(upstream))
 
         if self._mask is not None:
             self._mask.pre_compute_(engine, start, end)
 
+    def _rolling_key(self, upstream) -> tuple:
+        """Factors with the same rolling key get the same rolling input of `upstream`"""
+        return id(upstream), self.groupby, id(self._mask), self.win
+
     def _format_input(self, upstream, upstream_out, mask_factor, mask_out):
-        # If input.groupby not equal self.groupby, convert it
-        ret = self._regroup_by_other(upstream, upstream_out)
+        def regroup_and_mask():
+            # If input.groupby not equal self.groupby, convert it
+            ret = self._regroup_by_other(upstream, upstream_out)
 
-        if mask_out is not None:
-            mask = self._regroup_by_other(mask_factor, mask_out)
-            ret = ret.masked_fill(~mask, np.nan)
+            if mask_out is not None:
+                mask = self._regroup_by_other(mask_factor, mask_out)
+                ret = ret.masked_fill(~mask, np.nan)
+            return ret
 
-        # if need rolling and adjustment
+        # if need rolling and adjustment, rolling is built once for all factors use it
         if self.win > 1:
-            ret = Rolling(ret, self.win, upstream.adjustments)
-        return ret
+            return self._engine.rolling_(
+                self._rolling_key(upstream),
+                lambda: Rolling(regroup_and_mask(), self.win, upstream.adjustments))
+        return regroup_and_mask()
 
     def compute_(self, down_stream: Union[torch.cuda.Stream, None]) -> torch.Tensor:
-        # return cached result
-        self._ref_count -= 1
-        if self._ref_count < 0:
-            raise ValueError('Reference count error: Maybe you override `pre_compute_`, '
-                             'but did not call super() method.')
-        if self._cache is not None:
-            if down_stream:
-                down_stream.wait_event(self._cache_stream.record_event())
-            ret = self._cache
-            if self._ref_count == 0:
+        # return cached result, downstream may run in parallel threads
+        with _ref_count_lock:
+            self._ref_count -= 1
+            if self._ref_count < 0:
+                raise ValueError('Reference count error: Maybe you override `pre_compute_`, '
+                                 'but did not call super() method.')
+            ret, cache_stream = self._cache, self._cache_stream
+            if ret is not None and self._ref_count == 0:
                 self._cache = None
                 self._cache_stream = None
+        if ret is not None:
+            if down_stream:
+                down_stream.wait_event(cache_stream.record_event())
+            self._engine.profile_cache_hit_(self, ret)
             return ret
 
         # create self stream
@@ -344,6 +425,32 @@ class CustomFactor(BaseFactor):
             self._cache = out
         return out
 
+    def get_upstreams_(self) -> list:
+        """All upstream factors, including the mask"""
+        ret = [up for up in self.inputs or () if isinstance(up, BaseFactor)]
+        if self._mask is not None:
+            ret.append(self._mask)
+        return ret
+
+    def is_cached_(self) -> bool:
+        return self._cache is not None
+
+    def inject_cache_(self, data: torch.Tensor, stream: Union[torch.cuda.Stream, None]) -> None:
+        """
+        Set the result which computed elsewhere (such as asset shards), so upstream will not be
+        computed. Must be called after `pre_compute_`.
+        """
+        self._cache = data
+        self._cache_stream = stream
+
+    def schedule_compute_(self, stream: Union[torch.cuda.Stream, None]) -> torch.Tensor:
+        """
+        Compute in advance by engine scheduler, the result is kept in cache until the last
+        downstream has consumed it. All upstream must be scheduled before this.
+        """
+        self._ref_count += 1
+        return self.compute_(stream)
+
     def compute(self, *inputs: Sequence[torch.Tensor]) -> torch.Tensor:
         """
         Abstractmethod, do the actual factor calculation here.
@@ -420,6 +527,8 @@ class ShiftFactor(CustomFactor):
 
 
 class AbsFactor(CustomFactor):
+    _fuse_expr = '{0}.abs()'
+
     def compute(self, data: torch.Tensor) -> torch.Tensor:
         return data.abs()
 
@@ -432,7 +541,10 @@ class DoNothingFactor(CustomFactor):
 class RankFactor(TimeGroupFactor):
     ascending = True,
 
-    def compute(self, data: torch.Tensor) -> torch.Tensor:
+    def compute(self, data: torch.Tensor, groups: torch.Tensor = None) -> torch.Tensor:
+        if groups is not None:
+            ids, n_groups = dense_group_ids(groups)
+            return segment_rank(data, ids, n_groups, bool(self.ascending))
         if not self.ascending:
             filled = data.clone()
             filled.masked_fill_(torch.isnan(data), -np.inf)
@@ -446,23 +558,23 @@ class RankFactor(TimeGroupFactor):
 
 
 class DemeanFactor(TimeGroupFactor):
-    group_dict = None
 
-    def compute(self, data: torch.Tensor) -> torch.Tensor:
-        if self.group_dict is not None:
-            s = self._revert_to_series(data)
-            d = dict.fromkeys(s.index.levels[1], -1)
-            d.update(self.group_dict)
-            g = s.groupby([d, 'date'], level=1)
-            ret = g.transform(lambda x: x - x.mean())
-            return self._regroup(ret)
+    def compute(self, data: torch.Tensor, groups: torch.Tensor = None) -> torch.Tensor:
+        if groups is not None:
+            ids, n_groups = dense_group_ids(groups)
+            return data - segment_nanmean(data, ids, n_groups).gather(1, ids)
         else:
             return data - nanmean(data)[:, None]
 
 
 class ZScoreFactor(TimeGroupFactor):
 
-    def compute(self, data: torch.Tensor) -> torch.Tensor:
+    def compute(self, data: torch.Tensor, groups: torch.Tensor = None) -> torch.Tensor:
+        if groups is not None:
+            ids, n_groups = dense_group_ids(groups)
+            mean = segment_nanmean(data, ids, n_groups).gather(1, ids)
+            std = segment_nanstd(data, ids, n_groups).gather(1, ids)
+            return (data - mean) / std
         return (data - nanmean(data)[:, None]) / nanstd(data)[:, None]
 
 
@@ -476,23 +588,46 @@ class QuantileFactor(TimeGroupFactor):
     """return the quantile that factor belongs to each tick"""
     bins = 5
 
-    def compute(self, data: torch.Tensor) -> torch.Tensor:
-        x, _ = torch.sort(data, dim=1)
-        mask = torch.isnan(data)
-        act_size = data.shape[1] - mask.sum(dim=1)
+    def _grouped_bounds(self, data: torch.Tensor, groups: torch.Tensor) -> torch.Tensor:
+        """Bin boundaries of the group of each value, shape (bins + 1, *data.shape)"""
+        ids, n_groups = dense_group_ids(groups)
+        x, _, starts = segment_sort(data, ids, n_groups)
+        act_size = segment_count(data, ids, n_groups).long()
         q = np.linspace(0, 1, self.bins + 1, dtype=np.float32)
-        q = torch.tensor(q[:, None], device=data.device)
-        q_index = q * (act_size - 1)
+        q = torch.tensor(q[:, None, None], device=data.device)
+        q_index = starts + (q * (act_size - 1)).long()
         q_weight = q % 1
-        q_index = q_index.long()
         q_next = q_index + 1
-        q_next[-1] = act_size - 1
+        q_next[-1] = starts + act_size - 1
 
-        rows = torch.arange(data.shape[0], device=data.device)
-        b_start = x[rows, q_index]
-        b = b_start + (x[rows, q_next] - b_start) * q_weight
+        x = x.expand(self.bins + 1, -1, -1)
+        q_index.clamp_(0, data.shape[1] - 1)
+        q_next.clamp_(0, data.shape[1] - 1)
+        b_start = x.gather(2, q_index)
+        b = b_start + (x.gather(2, q_next) - b_start) * q_weight
         b[0] -= 1
-        b = b[:, :, None]
+        return b.gather(2, ids.expand(self.bins + 1, -1, -1))
+
+    def compute(self, data: torch.Tensor, groups: torch.Tensor = None) -> torch.Tensor:
+        if groups is not None:
+            b = self._grouped_bounds(data, groups)
+        else:
+            x, _ = torch.sort(data, dim=1)
+            mask = torch.isnan(data)
+            act_size = data.shape[1] - mask.sum(dim=1)
+            q = np.linspace(0, 1, self.bins + 1, dtype=np.float32)
+            q = torch.tensor(q[:, None], device=data.device)
+            q_index = q * (act_size - 1)
+            q_weight = q % 1
+            q_index = q_index.long()
+            q_next = q_index + 1
+            q_next[-1] = act_size - 1
+
+            rows = torch.arange(data.shape[0], device=data.device)
+            b_start = x[rows, q_index]
+            b = b_start + (x[rows, q_next] - b_start) * q_weight
+            b[0] -= 1
+            b = b[:, :, None]
 
         ret = data.new_full(data.shape, np.nan, dtype=torch.float32)
         for start, end, tile in zip(b[:-1], b[1:], range(self.bins)):
@@ -513,30 +648,68 @@ class ToWeightFactor(TimeGroupFactor):
 
 
 class SubFactor(CustomFactor):
+    _fuse_expr = '({0} - {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left - right
 
 
 class AddFactor(CustomFactor):
+    _fuse_expr = '({0} + {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left + right
 
 
 class MulFactor(CustomFactor):
+    _fuse_expr = '({0} * {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left * right
 
 
 class DivFactor(CustomFactor):
+    _fuse_expr = '({0} / {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left / right
 
 
 class PowFactor(CustomFactor):
+    _fuse_expr = '({0} ** {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left ** right
 
 
 class NegFactor(CustomFactor):
+    _fuse_expr = '(-{0})'
+
     def compute(self, left) -> torch.Tensor:
         return -left
+
+
+class FusedFactor(CustomFactor):
+    """
+    Multiple element-wise operator factors fused into one TorchScript function, created by
+    engine when operator fusion is enabled. `expr` is the expression of inputs `x0, x1, ...`.
+    """
+    def __init__(self, inputs: Sequence[BaseFactor], expr: str):
+        super().__init__(1, inputs)
+        self.expr = expr
+
+    def compute(self, *inputs: torch.Tensor) -> torch.Tensor:
+        return get_fused_function(self.expr, len(inputs))(*inputs)
+
+
+_fused_functions = {}
+
+
+def get_fused_function(expr: str, n_args: int):
+    """Compile (and cache) the TorchScript function of fused expression."""
+    key = (expr, n_args)
+    if key not in _fused_functions:
+        args = ', '.join(['x{}: Tensor'.format(i) for i in range(n_args)])
+        source = 'def fused({}) -> Tensor:\n    return {}\n'.format(args, expr)
+        _fused_functions[key] = torch.jit.CompilationUnit(source).fused
+    return _fused_functions[key]
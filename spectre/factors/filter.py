@@ -45,45 +45,63 @@ class StaticAssets(FilterFactor):
 
 
 class InvertFactor(FilterFactor):
+    _fuse_expr = '(~{0})'
+
     def compute(self, left) -> torch.Tensor:
         return ~left
 
 
 class OrFactor(FilterFactor):
+    _fuse_expr = '({0} | {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left | right
 
 
 class AndFactor(FilterFactor):
+    _fuse_expr = '({0} & {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return left & right
 
 
 class LtFactor(FilterFactor):
+    _fuse_expr = 'torch.lt({0}, {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return torch.lt(left, right)
 
 
 class LeFactor(FilterFactor):
+    _fuse_expr = 'torch.le({0}, {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return torch.le(left, right)
 
 
 class GtFactor(FilterFactor):
+    _fuse_expr = 'torch.gt({0}, {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return torch.gt(left, right)
 
 
 class GeFactor(FilterFactor):
+    _fuse_expr = 'torch.ge({0}, {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return torch.ge(left, right)
 
 
 class EqFactor(FilterFactor):
+    _fuse_expr = 'torch.eq({0}, {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return torch.eq(left, right)
 
 
 class NeFactor(FilterFactor):
+    _fuse_expr = 'torch.ne({0}, {1})'
+
     def compute(self, left, right) -> torch.Tensor:
         return torch.ne(left, right)
@@ -0,0 +1,103 @@
+"""
+@author: Heerozh (Zhang Jianhao)
+@copyright: Copyright 2019-2020, Heerozh. All rights reserved.
+@license: Apache 2.0
+@email: heeroz@gmail.com
+"""
+from contextlib import contextmanager
+from typing import Optional
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+
+class FactorProfiler:
+    """
+    Records the wall time, cpu time and memory usage of each factor and each stage of
+    `FactorEngine.run`. On cuda device, each record synchronizes the device, so the timing
+    is accurate but streams are no longer parallel. On cpu there are no allocator statistics,
+    `allocated_bytes` and `peak_bytes` are estimated as the output size, and
+    `memory_estimated` is True.
+    """
+
+    def __init__(self, device: torch.device):
+        self.device = device
+        self.events = []
+
+    def clear(self) -> None:
+        self.events = []
+
+    @contextmanager
+    def record(self, name: str, category: str, column: Optional[str] = None,
+               cache_hit: bool = False):
+        """
+        Record the code in `with` block as an event, set `event['output']` to the result tensor
+        to record its size.
+        """
+        cuda = self.device.type == 'cuda'
+        if cuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            mem_before = torch.cuda.memory_allocated(self.device)
+        event = dict(name=name, category=category, column=column, cache_hit=cache_hit,
+                     thread=threading.get_ident())
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        yield event
+        if cuda:
+            torch.cuda.synchronize(self.device)
+        event['start'] = start
+        event['wall_time'] = time.perf_counter() - start
+        event['cpu_time'] = time.thread_time() - cpu_start
+
+        output = event.get('output')
+        output_bytes = np.nan
+        if isinstance(output, torch.Tensor):
+            output_bytes = output.element_size() * output.nelement()
+        event['output_bytes'] = output_bytes
+        if cuda:
+            event['allocated_bytes'] = torch.cuda.memory_allocated(self.device) - mem_before
+            event['peak_bytes'] = torch.cuda.max_memory_allocated(self.device) - mem_before
+        else:
+            # no allocator statistics on cpu, the result is the only new tensor left
+            event['allocated_bytes'] = output_bytes
+            event['peak_bytes'] = output_bytes
+        event['memory_estimated'] = not cuda
+        # not keep the tensor alive
+        self.events.append({k: v for k, v in event.items() if k != 'output'})
+
+    def to_dataframe(self) -> pd.DataFrame:
+        columns = ['name', 'category', 'column', 'cache_hit', 'start', 'wall_time', 'cpu_time',
+                   'output_bytes', 'allocated_bytes', 'peak_bytes', 'memory_estimated', 'thread']
+        df = pd.DataFrame(self.events, columns=columns)
+        if len(df) > 0:
+            df['start'] -= df['start'].min()
+        return df
+
+    def to_chrome_trace(self, path: Optional[str] = None) -> str:
+        """
+        Return the events in Chrome trace event format (open in chrome://tracing or Perfetto),
+        and save to `path` if specified.
+        """
+        df = self.to_dataframe()
+        pid = os.getpid()
+        trace = []
+        for event in df.itertuples(index=False):
+            args = dict(column=event.column, cache_hit=event.cache_hit,
+                        cpu_time_ms=event.cpu_time * 1000,
+                        memory_estimated=event.memory_estimated)
+            for key in ('output_bytes', 'allocated_bytes', 'peak_bytes'):
+                value = getattr(event, key)
+                if not np.isnan(value):
+                    args[key] = int(value)
+            trace.append(dict(name=event.name, cat=event.category, ph='X', pid=pid,
+                              tid=event.thread, ts=event.start * 1e6,
+                              dur=event.wall_time * 1e6, args=args))
+        ret = json.dumps(dict(traceEvents=trace, displayTimeUnit='ms'))
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(ret)
+        return ret
@@ -4,7 +4,8 @@
 @license: Apache 2.0
 @email: heeroz@gmail.com
 """
-from .factor import CustomFactor
+from typing import Optional, Sequence
+from .factor import BaseFactor, CustomFactor
 from .engine import OHLCV
 from ..parallel import linear_regression_1d
 import torch
@@ -46,9 +47,53 @@ class RollingLinearRegression(CustomFactor):
         def lin_reg(x_, y_):
             m, b = linear_regression_1d(x_, y_, dim=2)
             return torch.cat([m.unsqueeze(-1), b.unsqueeze(-1)], dim=-1)
-        return x.agg(lin_reg, y)
+        return x.agg(lin_reg, y, footprint=3)
+
+
+class RollingRank(CustomFactor):
+    """Rank of the last value in its rolling window (ts_rank), 1 is the lowest."""
+    inputs = (OHLCV.close,)
+    win = 5
+    _min_win = 2
+
+    def __init__(self, win: Optional[int] = None, inputs: Optional[Sequence[BaseFactor]] = None,
+                 pct=False):
+        super().__init__(win, inputs)
+        self.pct = pct
+
+    def compute(self, data):
+        return data.nanrank(self.pct)
+
+
+class RollingQuantile(CustomFactor):
+    """
+    `q` quantile of each rolling window, linear interpolation between the two nearest values,
+    same as numpy nanquantile: nan in the window is ignored, all nan window is nan.
+    """
+    inputs = (OHLCV.close,)
+    win = 5
+    _min_win = 2
+
+    def __init__(self, win: Optional[int] = None, inputs: Optional[Sequence[BaseFactor]] = None,
+                 q=0.5):
+        super().__init__(win, inputs)
+        self.q = q
+
+    def compute(self, data):
+        return data.nanquantile(self.q)
+
+
+class RollingMedian(CustomFactor):
+    """Median of each rolling window, nan in the window is ignored, all nan window is nan."""
+    inputs = (OHLCV.close,)
+    win = 5
+    _min_win = 2
+
+    def compute(self, data):
+        return data.nanmedian()
 
 
 STDDEV = StandardDeviation
 MAX = RollingHigh
 MIN = RollingLow
+TS_RANK = RollingRank
@@ -9,8 +9,9 @@ from .factor import BaseFactor, CustomFactor
 from .basic import MA, EMA
 from .statistical import STDDEV
 from .engine import OHLCV
-from ..parallel import nanmean
+from ..parallel import nanmean, nanema, Rolling
 import numpy as np
+import torch
 
 
 class NormalizedBollingerBands(CustomFactor):
@@ -55,7 +56,7 @@ class MovingAverageConvergenceDivergenceSignal(EMA):
 
 
 class TrueRange(CustomFactor):
-    """ATR = MA(inputs=(TrueRange(),))"""
+    """Simple ATR = MA(inputs=(TrueRange(),)), or Wilder's ATR by AverageTrueRange"""
     inputs = (OHLCV.high, OHLCV.low, OHLCV.close)
     win = 2
     _min_win = 2
@@ -93,10 +94,8 @@ class RSI(CustomFactor):
                 return 1 - (2 / (1 + up / down))
             else:
                 return 100 - (100 / (1 + up / down))
-            # Wilder's RSI
-            # up = up.ewm(com=14-1, adjust=False).mean()
-            # down = down.ewm(com=14-1, adjust=False).mean().abs()
-        return closes.agg(_rsi)
+            # Wilder's RSI see WilderRSI
+        return closes.agg(_rsi, footprint=5)
 
 
 class FastStochasticOscillator(CustomFactor):
@@ -116,7 +115,125 @@ class FastStochasticOscillator(CustomFactor):
             return k * 100
 
 
+class WildersSmoothedFactor(CustomFactor):
+    """
+    Base class of indicators using Wilder's smoothing (EMA with alpha = 1 / period), computed by
+    exact recursion from the window of smoothing (same as `EMA`), no window unfolding. `win` is
+    the period, the actual window of factor is the window of smoothing plus its previous bar.
+    """
+    _min_win = 2
+
+    def __init__(self, win: Optional[int] = None, inputs: Optional[Sequence[BaseFactor]] = None):
+        super().__init__(win, inputs)
+        self.period = self.win
+        # Same 99.97% accuracy as EMA, Wilder's period n equals to EMA span 2n-1
+        self.smooth_win = int(4.5 * 2 * self.period)
+        self.win = self.smooth_win + 1
+
+    def smooth(self, x):
+        return nanema(x, 1 / self.period, win=self.smooth_win)
+
+    @classmethod
+    def previous(cls, x):
+        """Previous non-nan value of each row, so nan gap is skipped."""
+        ffill = Rolling.last_nonnan_of(x, x.shape[1])
+        return torch.cat((x.new_full((x.shape[0], 1), np.nan), ffill[:, :-1]), dim=1)
+
+    @classmethod
+    def true_range(cls, highs, lows, closes):
+        prev_close = cls.previous(closes)
+        ret = torch.fmax(highs - lows, torch.fmax((highs - prev_close).abs(),
+                                                  (lows - prev_close).abs()))
+        return ret.masked_fill_(torch.isnan(highs + lows + prev_close), np.nan)
+
+
+class WilderRSI(WildersSmoothedFactor):
+    inputs = (OHLCV.close,)
+    win = 14
+    normalize = False
+
+    def compute(self, closes):
+        x, _ = closes.whole_series()
+        diff = x - self.previous(x)
+        up = self.smooth(diff.clamp(min=0))
+        down = self.smooth((-diff).clamp(min=0))
+        if self.normalize:
+            ret = 1 - (2 / (1 + up / down))
+        else:
+            ret = 100 - (100 / (1 + up / down))
+        return ret.to(closes.x.dtype)
+
+
+class AverageTrueRange(WildersSmoothedFactor):
+    inputs = (OHLCV.high, OHLCV.low, OHLCV.close)
+    win = 14
+
+    def compute(self, highs, lows, closes):
+        c, last = closes.whole_series()
+        ret = self.smooth(self.true_range(highs.whole_series()[0], lows.whole_series()[0], c))
+        if last is not None:
+            ret = ret / last
+        return ret.to(closes.x.dtype)
+
+
+class AverageDirectionalIndex(WildersSmoothedFactor):
+    inputs = (OHLCV.high, OHLCV.low, OHLCV.close)
+    win = 14
+
+    def __init__(self, win: Optional[int] = None, inputs: Optional[Sequence[BaseFactor]] = None):
+        super().__init__(win, inputs)
+        # dx is smoothed again
+        self.win = 2 * self.smooth_win
+
+    def compute(self, highs, lows, closes):
+        high, low = highs.whole_series()[0], lows.whole_series()[0]
+        up = high - self.previous(high)
+        down = self.previous(low) - low
+        plus_dm = torch.where((up > down) & (up > 0), up, up.new_zeros(()))
+        minus_dm = torch.where((down > up) & (down > 0), down, down.new_zeros(()))
+        tr = self.true_range(high, low, closes.whole_series()[0])
+        isnan = torch.isnan(up + down + tr)
+        tr = self.smooth(tr)
+        plus_di = self.smooth(plus_dm.masked_fill_(isnan, np.nan)) / tr
+        minus_di = self.smooth(minus_dm.masked_fill_(isnan, np.nan)) / tr
+        dx = 100 * (plus_di - minus_di).abs() / (plus_di + minus_di)
+        return self.smooth(dx).to(closes.x.dtype)
+
+
+class ChaikinOscillator(CustomFactor):
+    """ Chaikin A/D Oscillator, EMA(fast) - EMA(slow) of the Accumulation/Distribution Line. """
+    inputs = (OHLCV.high, OHLCV.low, OHLCV.close, OHLCV.volume)
+    win = 10
+    _min_win = 2
+
+    def __init__(self, fast=3, slow=10, inputs: Optional[Sequence[BaseFactor]] = None):
+        super().__init__(slow, inputs)
+        self.fast = fast
+        self.slow = self.win
+        # recursion starts from the first value of window, same as EMA
+        self.win = int(4.5 * (max(self.fast, self.slow) + 1))
+
+    def compute(self, highs, lows, closes, volumes):
+        # close location value, adjustments of prices cancel out
+        high, low, close = highs.x.double(), lows.x.double(), closes.x.double()
+        clv = ((close - low) - (high - close)) / (high - low)
+        clv = clv.masked_fill(high <= low, 0)
+        v, last = volumes.whole_series()
+        money_flow = clv * v
+        isnan = torch.isnan(money_flow)
+        # constant offset of A/D line cancels out in fast - slow, start point doesn't matter
+        ad = money_flow.masked_fill(isnan, 0).cumsum(dim=1).masked_fill_(isnan, np.nan)
+        ret = nanema(ad, 2 / (self.fast + 1), win=self.win) - \
+            nanema(ad, 2 / (self.slow + 1), win=self.win)
+        if last is not None:
+            ret = ret / last
+        return ret.to(closes.x.dtype)
+
+
 BBANDS = NormalizedBollingerBands
 MACD = MovingAverageConvergenceDivergenceSignal
 TRANGE = TrueRange
 STOCHF = FastStochasticOscillator
+ATR = AverageTrueRange
+ADX = AverageDirectionalIndex
+ADOSC = ChaikinOscillator
@@ -1,5 +1,6 @@
 from .algorithmic import (
     ParallelGroupBy,
+    AlignedGroupBy,
     Rolling,
     nansum,
     nanmean,
@@ -7,7 +8,17 @@ from .algorithmic import (
     nanlast,
     nanmax,
     nanmin,
+    nanquantile,
+    dense_group_ids,
+    segment_count,
+    segment_nansum,
+    segment_nanmean,
+    segment_nanstd,
+    segment_sort,
+    segment_rank,
     covariance,
     pearsonr,
     linear_regression_1d,
+    linear_scan,
+    nanema,
 )
\ No newline at end of file
@@ -4,7 +4,8 @@
 @license: Apache 2.0
 @email: heeroz@gmail.com
 """
-from typing import Callable, Tuple
+from typing import Callable, Tuple, Union
+import os
 import torch
 import numpy as np
 
@@ -14,28 +15,42 @@ class ParallelGroupBy:
 
     def __init__(self, keys: torch.Tensor):
         n = keys.shape[0]
-        # sort by key (keep key in GPU device)
-        relative_key = keys + torch.linspace(0, 0.9, n, dtype=torch.double, device=keys.device)
-        sorted_keys, sorted_indices = torch.sort(relative_key)
-        sorted_keys, sorted_indices = sorted_keys.int(), sorted_indices.cpu()
+        # stable sort by key (keep key in GPU device), key * n + i is unique
+        arange = torch.arange(n, device=keys.device)
+        _, sorted_indices = torch.sort(keys.long() * n + arange)
+        sorted_keys = keys[sorted_indices]
         # get group boundary
-        diff = sorted_keys[1:] - sorted_keys[:-1]
-        boundary = (diff.nonzero(as_tuple=True)[0] + 1).tolist()
-        boundary = np.array([0] + boundary + [n])
-        # get inverse indices
-        width = np.diff(boundary).max()
-        groups = len(boundary) - 1
-        inverse_indices = sorted_indices.new_full((groups, width), n + 1).pin_memory()
-        for start, end, i in zip(boundary[:-1], boundary[1:], range(groups)):
-            inverse_indices[i, 0:(end - start)] = sorted_indices[start:end]
-        # keep inverse_indices in GPU for sort
-        inverse_indices = inverse_indices.flatten().to(keys.device, non_blocking=True)
-        inverse_indices = torch.sort(inverse_indices)[1][:n]
+        _, counts = torch.unique_consecutive(sorted_keys, return_counts=True)
+        self._build(sorted_indices, counts)
+
+    @classmethod
+    def from_sorted(cls, sorted_indices: torch.Tensor, counts: torch.Tensor):
+        """
+        Create from a known stable sorted order of keys, and the (non-zero) size of each group
+        in that order, skip sorting.
+        """
+        ret = cls.__new__(cls)
+        ret._build(sorted_indices, counts)
+        return ret
+
+    def _build(self, sorted_indices: torch.Tensor, counts: torch.Tensor):
+        n = sorted_indices.shape[0]
+        device = sorted_indices.device
+        arange = torch.arange(n, device=device)
+        groups = counts.shape[0]
+        width = int(counts.max())
+        offsets = torch.cumsum(counts, dim=0)
+        boundary = np.concatenate([[0], offsets.cpu().numpy()])
+        # position of each sorted element in (groups, width) layout
+        group_ids = torch.repeat_interleave(torch.arange(groups, device=device), counts)
+        flat_pos = group_ids * width + arange - (offsets - counts)[group_ids]
         # for fast split
-        take_indices = sorted_indices.new_full((groups, width), -1)
-        for start, end, i in zip(boundary[:-1], boundary[1:], range(groups)):
-            take_indices[i, 0:(end - start)] = sorted_indices[start:end]
-        take_indices = take_indices.to(keys.device, non_blocking=True)
+        take_indices = sorted_indices.new_full((groups * width,), -1)
+        take_indices[flat_pos] = sorted_indices
+        take_indices = take_indices.view(groups, width)
+        # for revert
+        inverse_indices = torch.empty_like(sorted_indices)
+        inverse_indices[sorted_indices] = flat_pos
         # class members
         self._boundary = boundary
         self._sorted_indices = take_indices
@@ -45,6 +60,10 @@ class ParallelGroupBy:
         self._groups = groups
         self._data_shape = (groups, width)
 
+    @property
+    def data_shape(self):
+        return self._data_shape
+
     def split(self, data: torch.Tensor) -> torch.Tensor:
         ret = torch.take(data, self._sorted_indices)
         assert ret.type not in {torch.int8, torch.int16, torch.int32, torch.int64}, \
@@ -52,7 +71,7 @@ class ParallelGroupBy:
         ret.masked_fill_(self._padding_mask, np.nan)
         return ret
 
-    def revert(self, split_data: torch.Tensor, dbg_str='None') -> torch.Tensor:
+    def _check_shape(self, split_data: torch.Tensor, dbg_str: str) -> None:
         if tuple(split_data.shape) != self._data_shape:
             if tuple(split_data.shape[:2]) == self._data_shape[:2]:
                 raise ValueError('The downstream needs shape{2}, and the input factor "{1}" is '
@@ -63,6 +82,9 @@ class ParallelGroupBy:
             else:
                 raise ValueError('The return data shape{} of Factor `{}` must same as input{}.'
                                  .format(tuple(split_data.shape), dbg_str, self._data_shape))
+
+    def revert(self, split_data: torch.Tensor, dbg_str='None') -> torch.Tensor:
+        self._check_shape(split_data, dbg_str)
         return torch.take(split_data, self._inverse_indices)
 
     def create(self, dtype, values, nan_fill=np.nan):
@@ -71,6 +93,33 @@ class ParallelGroupBy:
         return ret
 
 
+class AlignedGroupBy(ParallelGroupBy):
+    """
+    Group by of data which is a full (dates, assets) grid in date major order, such as
+    aligned by time. Split is a view (transposed if group by asset), revert is a reshape,
+    no gathering and no padding.
+    """
+
+    def __init__(self, dates: int, assets: int, by_asset: bool, device: torch.device):
+        self._by_asset = by_asset
+        self._device = device
+        self._grid_shape = (dates, assets)
+        self._data_shape = (assets, dates) if by_asset else (dates, assets)
+
+    def split(self, data: torch.Tensor) -> torch.Tensor:
+        ret = data.reshape(self._grid_shape)
+        return ret.t() if self._by_asset else ret
+
+    def revert(self, split_data: torch.Tensor, dbg_str='None') -> torch.Tensor:
+        self._check_shape(split_data, dbg_str)
+        if self._by_asset:
+            split_data = split_data.t()
+        return split_data.reshape(-1)
+
+    def create(self, dtype, values, nan_fill=np.nan):
+        return torch.full(self._data_shape, values, dtype=dtype, device=self._device)
+
+
 def _nansum(data: torch.Tensor, dim=1) -> Tuple[torch.Tensor, torch.Tensor]:
     data = data.clone()
     isnan = torch.isnan(data)
@@ -127,6 +176,81 @@ def nanlast(data: torch.Tensor, dim=1) -> torch.Tensor:
         return ret
 
 
+def nanquantile(data: torch.Tensor, q: float, dim=1) -> torch.Tensor:
+    """Same as numpy nanquantile (linear interpolation) by sorting, nan if all nan."""
+    isnan = torch.isnan(data)
+    count = (~isnan).sum(dim=dim, keepdim=True)
+    data = data.masked_fill(isnan, np.inf).sort(dim=dim)[0]
+    pos = (count - 1).clamp(min=0).to(data.dtype) * q
+    lo = pos.floor()
+    low = data.gather(dim, lo.long())
+    high = data.gather(dim, pos.ceil().long())
+    ret = torch.where(pos == lo, low, low + (high - low) * (pos - lo))
+    return ret.masked_fill_(count == 0, np.nan).squeeze(dim)
+
+
+def dense_group_ids(groups: torch.Tensor) -> Tuple[torch.Tensor, int]:
+    """
+    Convert group keys (nan is a group too) to ids in [0, n_groups), for the segment_* functions.
+    """
+    keys = groups.masked_fill(torch.isnan(groups), -np.inf)
+    uniques, ids = torch.unique(keys, return_inverse=True)
+    return ids, uniques.shape[0]
+
+
+def _segment_reduce(values: torch.Tensor, ids: torch.Tensor, n_groups: int) -> torch.Tensor:
+    rows = torch.arange(ids.shape[0], device=ids.device)[:, None]
+    ret = values.new_zeros(ids.shape[0] * n_groups)
+    ret.scatter_add_(0, (rows * n_groups + ids).flatten(), values.flatten())
+    return ret.view(ids.shape[0], n_groups)
+
+
+def segment_count(data: torch.Tensor, ids: torch.Tensor, n_groups: int) -> torch.Tensor:
+    """Non-nan count of each group in each row of 2d `data`, return shape (rows, n_groups)."""
+    return _segment_reduce((~torch.isnan(data)).to(data.dtype), ids, n_groups)
+
+
+def segment_nansum(data: torch.Tensor, ids: torch.Tensor, n_groups: int) -> torch.Tensor:
+    return _segment_reduce(data.masked_fill(torch.isnan(data), 0), ids, n_groups)
+
+
+def segment_nanmean(data: torch.Tensor, ids: torch.Tensor, n_groups: int) -> torch.Tensor:
+    return segment_nansum(data, ids, n_groups) / segment_count(data, ids, n_groups)
+
+
+def segment_nanstd(data: torch.Tensor, ids: torch.Tensor, n_groups: int, ddof=0) -> torch.Tensor:
+    mean = segment_nanmean(data, ids, n_groups)
+    var = segment_nansum((data - mean.gather(1, ids)) ** 2, ids, n_groups)
+    return (var / (segment_count(data, ids, n_groups) - ddof)).sqrt()
+
+
+def segment_sort(data: torch.Tensor, ids: torch.Tensor, n_groups: int, descending=False) \
+        -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Sort each row of 2d `data` by (group, value), nan last in group.
+    Return the sorted values, sorted indices, and the start position of each group.
+    """
+    filled = data
+    if descending:
+        filled = data.masked_fill(torch.isnan(data), -np.inf)
+    _, by_value = torch.sort(filled, dim=1, descending=descending, stable=True)
+    _, by_group = torch.sort(ids.gather(1, by_value), dim=1, stable=True)
+    indices = by_value.gather(1, by_group)
+    sizes = _segment_reduce(torch.ones_like(data, dtype=torch.long), ids, n_groups)
+    starts = sizes.cumsum(dim=1) - sizes
+    return data.gather(1, indices), indices, starts
+
+
+def segment_rank(data: torch.Tensor, ids: torch.Tensor, n_groups: int, ascending=True) \
+        -> torch.Tensor:
+    """Ordinal rank (starts from 1) of each value in its group of the row, nan is not ranked."""
+    _, indices, starts = segment_sort(data, ids, n_groups, descending=not ascending)
+    positions = torch.arange(data.shape[1], device=data.device).expand_as(indices)
+    rank = torch.empty_like(indices).scatter_(1, indices, positions)
+    rank = (rank - starts.gather(1, ids) + 1).to(data.dtype)
+    return rank.masked_fill_(torch.isnan(data), np.nan)
+
+
 def covariance(x, y, dim=1, ddof=0):
     x_bar = nanmean(x, dim=dim).unsqueeze(-1)
     y_bar = nanmean(y, dim=dim).unsqueeze(-1)
@@ -154,8 +278,87 @@ def linear_regression_1d(x, y, dim=1):
     return slope, intcp
 
 
+def linear_scan(x: torch.Tensor, decay: torch.Tensor) -> torch.Tensor:
+    """
+    Exact first order recurrence along dim 1: y[:, t] = decay[:, t] * y[:, t-1] + x[:, t], decay
+    in [0, 1], result is float64. Time axis is split into chunks short enough that cumprod of
+    decay not underflow, inside a chunk y = P * cumsum(x / P), then carry chunk by chunk.
+    """
+    x = x.double()
+    decay = decay.double()
+    rows, length = x.shape
+    min_decay = decay.min().item() if decay.nelement() > 0 else 1.
+    if min_decay < np.exp(-200 / 16):
+        # tiny decay (such as 0 of `EMA(span=1)`) makes chunks too short, use log-step scan,
+        # y of each step covers 2x bars, no division.
+        y, step = x, 1
+        while step < length:
+            y = torch.cat((y[:, :step], y[:, step:] + decay[:, step:] * y[:, :-step]), dim=1)
+            decay = torch.cat((decay[:, :step], decay[:, step:] * decay[:, :-step]), dim=1)
+            step *= 2
+        return y
+    chunk = length if min_decay >= 1 else int(-200 / np.log(min_decay))
+    chunk = min(max(chunk, 1), max(length, 1))
+    pad = -length % chunk
+    x = torch.cat((x, x.new_zeros(rows, pad)), dim=1).view(rows, -1, chunk)
+    decay = torch.cat((decay, decay.new_ones(rows, pad)), dim=1).view(rows, -1, chunk)
+    p = decay.cumprod(dim=2)
+    y = p * (x / p).cumsum(dim=2)
+    for i in range(1, y.shape[1]):
+        y[:, i] += p[:, i] * y[:, i - 1, -1:]
+    return y.view(rows, -1)[:, :length]
+
+
+def nanema(data: torch.Tensor, alpha: float, adjust=False,
+           win: Union[int, None] = None) -> torch.Tensor:
+    """
+    Exponential moving average along dim 1 by exact recursion in float64, nan is skipped (the
+    last average is carried), same as pandas `ewm(alpha=alpha, adjust=adjust, ignore_na=True)`.
+    If `win` is set, the recursion of each result starts from its last `win` bars (same as ewm of
+    the window), so the result doesn't depend on how much history is loaded.
+    """
+    valid = ~torch.isnan(data)
+    x = data.masked_fill(~valid, 0)
+    decay = 1 - alpha * valid.double()
+    count = valid.cumsum(dim=1)
+    if win is None:
+        if adjust:
+            return linear_scan(x, decay) / linear_scan(valid, decay)
+        # first value as seed
+        ret = linear_scan(torch.where(count == 1, x, x * alpha), decay)
+        return ret.masked_fill_(count == 0, np.nan)
+
+    def shift(y):
+        return torch.cat((y.new_zeros(y.shape[0], min(win, y.shape[1])), y[:, :-win]), dim=1)
+
+    # recursion before the window is decayed by all values of the window, remove it
+    window_count = count - shift(count)
+    window_decay = (1 - alpha) ** window_count.double()
+
+    def windowed(y):
+        return y - window_decay * shift(y)
+
+    x = x.double()
+    if adjust:
+        return windowed(linear_scan(x, decay)) / windowed(linear_scan(valid, decay))
+    # first value of window as seed
+    pos = torch.arange(x.shape[1], device=x.device).expand_as(x)
+    next_valid = torch.where(valid, pos, pos.new_full((), x.shape[1] - 1))
+    next_valid = next_valid.flip(1).cummin(dim=1)[0].flip(1)
+    seed = x.gather(1, next_valid.gather(1, (pos - win + 1).clamp(min=0)))
+    ret = windowed(linear_scan(x * alpha, decay)) + window_decay * seed
+    return ret.masked_fill_(window_count == 0, np.nan)
+
+
 class Rolling:
-    _split_multi = 64  # 32-64 recommended, you can tune this for kernel performance
+    # Estimated memory of `agg` op (adjusted copies and intermediates), in multiples of the window
+    # data of its inputs, used to plan the chunks of `agg` if the op has no `footprint`.
+    _split_multi = 4
+    # Max memory (bytes) of each `agg` chunk. None is a quarter of the free memory of device, and
+    # at most 256MB on cuda (fewer kernel launches) or 16MB on cpu (chunks fit in cache).
+    memory_budget = None
+    _selection_win = 32  # window below this, quantile sorts windows instead of selection
+    _prefix_chunk = 2 ** 22  # elements of each row chunk of prefix sum backend, limits memory
 
     @classmethod
     def unfold(cls, x, win, fill=np.nan):
@@ -163,91 +366,408 @@ class Rolling:
         new_x = torch.cat((nan_stack, x), dim=1)
         return new_x.unfold(1, win, 1)
 
+    @classmethod
+    def last_nonnan_of(cls, x, win):
+        """Same as `Rolling(x, win).last_nonnan()`, but forward fill by index, O(n)."""
+        t = torch.arange(x.shape[1], device=x.device)
+        pos = torch.where(torch.isnan(x), -1, t).cummax(dim=1)[0]
+        ret = x.gather(1, pos.clamp(min=0))
+        return ret.masked_fill_(pos <= t - win, np.nan)
+
+    @classmethod
+    def prefix_window_sum(cls, x, win):
+        """
+        Sum of each rolling window in float64, O(n) regardless of window.
+        Split time axis into blocks of `win`, a window is the prefix of its block plus the suffix
+        of previous block, so there is no subtraction of large prefix sums (no cancellation).
+        """
+        length = x.shape[1]
+        blocks = x.double()
+        blocks = torch.cat((blocks, blocks.new_zeros(x.shape[0], -length % win)), dim=1)
+        blocks = blocks.view(x.shape[0], -1, win)
+        prefix = blocks.cumsum(dim=2)
+        suffix = blocks.flip(2).cumsum(dim=2).flip(2)
+        # suffix of previous block after position j
+        prev = torch.zeros_like(suffix)
+        prev[:, 1:, :-1] = suffix[:, :-1, 1:]
+        return (prefix + prev).view(x.shape[0], -1)[:, :length]
+
+    @classmethod
+    def block_window_m2(cls, x, valid, win):
+        """
+        Sum of squared deviations from the mean (M2) of each rolling window in float64, O(n)
+        regardless of window. `x` is nan filled, `valid` is the mask of non-nan values.
+        Blocks are split as `prefix_window_sum` and centered by their means. M2 of block prefixes
+        and suffixes are cumsum of Welford's increments (non-negative, no cancellation), and a
+        window combines its two parts by Chan's parallel formula.
+        """
+        rows, length = x.shape
+        pad = -length % win
+        x = torch.cat((x.double(), x.new_zeros(rows, pad, dtype=torch.float64)), dim=1)
+        valid = torch.cat((valid.double(), valid.new_zeros(rows, pad, dtype=torch.float64)), dim=1)
+        x, valid = x.view(rows, -1, win), valid.view(rows, -1, win)
+        center = ((x * valid).sum(dim=2, keepdim=True) /
+                  valid.sum(dim=2, keepdim=True)).nan_to_num_()
+        x = (x - center) * valid
+
+        def moments(y, v):
+            count = v.cumsum(dim=2)
+            mean = (y.cumsum(dim=2) / count).nan_to_num_()
+            prev_mean = torch.cat((mean.new_zeros(mean.shape[:2] + (1,)), mean[:, :, :-1]), dim=2)
+            m2 = ((y - prev_mean) * (y - mean) * v).cumsum(dim=2)
+            return count, mean + center, m2
+
+        count_a, mean_a, m2_a = moments(x, valid)
+        count_b, mean_b, m2_b = map(lambda t: t.flip(2), moments(x.flip(2), valid.flip(2)))
+        # suffix of previous block after position j
+        suffix = [torch.zeros_like(t) for t in (count_b, mean_b, m2_b)]
+        for dst, src in zip(suffix, (count_b, mean_b, m2_b)):
+            dst[:, 1:, :-1] = src[:, :-1, 1:]
+        count_b, mean_b, m2_b = suffix
+        delta = mean_b - mean_a
+        count = count_a + count_b
+        m2 = m2_a + m2_b + (delta * delta * count_a * count_b / count).nan_to_num_()
+        return m2.view(rows, -1)[:, :length]
+
+    @classmethod
+    def block_window_max(cls, x, win):
+        """
+        Max of each rolling window (nan must be filled), van Herk/Gil-Werman algorithm, O(n)
+        regardless of window. Time axis is split into blocks of `win`, a window is the prefix
+        of its block plus the suffix of previous block.
+        """
+        length = x.shape[1]
+        blocks = torch.cat((x, x.new_full((x.shape[0], -length % win), -np.inf)), dim=1)
+        blocks = blocks.view(x.shape[0], -1, win)
+        prefix = blocks.cummax(dim=2)[0]
+        suffix = blocks.flip(2).cummax(dim=2)[0].flip(2)
+        prev = torch.full_like(suffix, -np.inf)
+        prev[:, 1:, :-1] = suffix[:, :-1, 1:]
+        return torch.max(prefix, prev).view(x.shape[0], -1)[:, :length]
+
+    def whole_series(self) -> Tuple[torch.Tensor, Union[torch.Tensor, None]]:
+        """
+        For recursive (unbounded window) calculation: values of the whole series multiplied by
+        adjustments, and the adjustment of each row which the result should be divided by.
+        """
+        if self._adjustment is None:
+            return self.x, None
+        adjustment = self._adjustment
+        return self._adjusted_x, self.last_nonnan_of(adjustment, adjustment.shape[1])
+
     def __init__(self, x: torch.Tensor, win: int, _adjustment: torch.Tensor = None):
+        adjustment_last = None
+        if _adjustment is not None:
+            adjustment_last = self.last_nonnan_of(_adjustment, win)
+        self._setup(x, win, _adjustment, adjustment_last)
+
+    def _setup(self, x, win, adjustment, adjustment_last):
+        self.x = x
         self.values = self.unfold(x, win)
         self.win = win
 
-        # rolling multiplication will consume lot of memory, split it by size
-        memory_usage = self.values.nelement() / (1024. ** 3)
-        memory_usage *= Rolling._split_multi
-        step = max(int(self.values.shape[0] / memory_usage), 1)
-        boundary = list(range(0, self.values.shape[0], step)) + [self.values.shape[0]]
-        self.split = list(zip(boundary[:-1], boundary[1:]))
-
-        if _adjustment is not None:
-            rolling_adj = Rolling(_adjustment, win)
-            self.adjustments = rolling_adj.values
-            self.adjustment_last = rolling_adj.last_nonnan()[:, :, None]
+        self._adjustment = adjustment
+        self._adjustment_last = adjustment_last
+        if adjustment is not None:
+            # multiply adjustments once on the series, windows only need to divide by the last
+            self._adjusted_x = x * adjustment
+            self.adjusted_values = self.unfold(self._adjusted_x, win)
+            self.adjustments = self.unfold(adjustment, win)
+            self.adjustment_last = adjustment_last[:, :, None]
         else:
+            self._adjusted_x = x
+            self.adjusted_values = self.values
             self.adjustments = None
             self.adjustment_last = None
 
+    def __mul__(self, other: 'Rolling') -> 'Rolling':
+        """Rolling of the product, same as multiplying the adjusted windows of both."""
+        assert self.win == other.win, '`other` must have same `win` with `self`'
+        adjustment, adjustment_last = self._adjustment, self._adjustment_last
+        if other._adjustment is not None:
+            if adjustment is None:
+                adjustment, adjustment_last = other._adjustment, other._adjustment_last
+            else:
+                adjustment = adjustment * other._adjustment
+                adjustment_last = adjustment_last * other._adjustment_last
+        ret = Rolling.__new__(Rolling)
+        ret._setup(self.x * other.x, self.win, adjustment, adjustment_last)
+        ret.memory_budget = self.memory_budget
+        return ret
+
+    def _prefix_reduce(self, reduce: Callable, m2=False, abs_=False, empty=None,
+                       full_window=False) -> Union[torch.Tensor, None]:
+        """
+        Compute the non-nan count, sum and M2 (`block_window_m2`) of each window by prefix sums,
+        O(n) regardless of window, then `reduce(count, total, m2, center)` to the result.
+        Values are centered by their row mean (`center`) before summing, to reduce the rounding
+        error. Computed by row chunks to limit memory. Return None if there are inf values,
+        prefix sums can't handle them.
+        :param abs_: result is divided by the abs of last adjustment, instead of itself.
+        :param empty: result of all nan window, None for nan.
+        :param full_window: result is nan if window contains nan.
+        """
+        if not self.x.is_floating_point():
+            return None
+        dtype = self.x.dtype
+        if self._adjustment is not None:
+            dtype = torch.result_type(self.x, self._adjustment)
+        rows = max(Rolling._prefix_chunk // max(self.x.shape[1], 1), 1)
+        seq = []
+        for s in range(0, self.x.shape[0], rows):
+            y = self._adjusted_x[s:s + rows]
+            if torch.isinf(y).any():
+                return None
+            isnan = torch.isnan(y)
+            count = self.prefix_window_sum(~isnan, self.win)
+            center = nanmean(y.double(), dim=1).nan_to_num_()[:, None]
+            y = (y.double() - center).masked_fill_(isnan, 0)
+            total = self.prefix_window_sum(y, self.win)
+            ret = reduce(count, total, self.block_window_m2(y, ~isnan, self.win) if m2 else None,
+                         center)
+            if self._adjustment_last is not None:
+                last = self._adjustment_last[s:s + rows]
+                ret = ret / (last.abs() if abs_ else last)
+            if empty is not None:
+                ret.masked_fill_(count == 0, empty)
+            if full_window:
+                ret.masked_fill_(count < self.win, np.nan)
+            seq.append(ret.to(dtype))
+        return torch.cat(seq)
+
+    def _block_extrema(self, largest: bool, full_window: bool) -> Union[torch.Tensor, None]:
+        """
+        Max (or min) of each window by `block_window_max`, nan is ignored (same as nanmax,
+        all nan window is -inf), or result is nan if window contains nan if `full_window`.
+        Return None if not supported.
+        """
+        if not self.x.is_floating_point():
+            return None
+        last = self._adjustment_last
+        if last is not None and (last < 0).any():
+            return None  # max becomes min
+        sign = 1 if largest else -1
+        rows = max(Rolling._prefix_chunk // max(self.x.shape[1], 1), 1)
+        seq = []
+        for s in range(0, self.x.shape[0], rows):
+            y = self._adjusted_x[s:s + rows]
+            isnan = torch.isnan(y)
+            ret = self.block_window_max((y * sign).masked_fill_(isnan, -np.inf), self.win)
+            if last is not None:
+                ret = ret / last[s:s + rows]
+                # all nan window
+                ret.masked_fill_(ret.isnan(), -np.inf)
+            if full_window:
+                nans = self.prefix_window_sum(isnan, self.win)
+                nans[:, :self.win - 1] += 1  # padding of unfold
+                ret.masked_fill_(nans > 0, np.nan)
+            seq.append(ret * sign)
+        return torch.cat(seq)
+
+    def _fast_nansum(self, full_window: bool):
+        return self._prefix_reduce(lambda count, total, _, center: total + count * center,
+                                   empty=0, full_window=full_window)
+
+    def _fast_nanmean(self, full_window: bool):
+        return self._prefix_reduce(lambda count, total, _, center: total / count + center,
+                                   full_window=full_window)
+
+    def _fast_nanstd(self, full_window: bool):
+        # same as nanstd, std of all nan is 0
+        return self._prefix_reduce(lambda count, _, m2, __: (m2 / count).sqrt(), m2=True,
+                                   abs_=True, empty=0, full_window=full_window)
+
     def adjusted(self, s=None, e=None) -> torch.Tensor:
         """this will contiguous tensor consume lot of memory, limit e-s size"""
         if self.adjustments is not None:
-            return self.values[s:e] * self.adjustments[s:e] / self.adjustment_last[s:e]
+            return self.adjusted_values[s:e] / self.adjustment_last[s:e]
         else:
             return self.values[s:e]
 
     def __repr__(self):
         return 'spectre.parallel.Rolling object contains:\n' + self.values.__repr__()
 
-    def agg(self, op: Callable, *others: 'Rolling'):
+    @classmethod
+    def free_memory(cls, device: torch.device) -> int:
+        """Free memory (bytes) of `device`."""
+        if device.type == 'cuda':
+            return torch.cuda.mem_get_info(device)[0]
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return 4 * 1024 ** 3
+
+    def plan_split(self, *others: 'Rolling', footprint: float = None) -> list:
+        """
+        Split rows into chunks, so the estimated memory of `agg` on each chunk, with `others` as
+        extra inputs, is within the `memory_budget`.
+        :param footprint: memory of the op intermediates, in multiples of the window data of
+            inputs, the adjusted copies of inputs are added. None is `_split_multi`.
+        """
+        rows = self.values.shape[0]
+        budget = self.memory_budget
+        if budget is None:
+            cap = 2 ** 28 if self.x.is_cuda else 2 ** 24
+            budget = min(self.free_memory(self.x.device) // 4, cap)
+        inputs = (self,) + others
+        window_bytes = [r.values[0:1].nelement() * r.values.element_size() for r in inputs]
+        if footprint is None:
+            row_bytes = sum(window_bytes) * self._split_multi
+        else:
+            copies = sum(b for r, b in zip(inputs, window_bytes) if r.adjustments is not None)
+            row_bytes = sum(window_bytes) * footprint + copies
+        step = max(int(budget // max(row_bytes, 1)), 1)
+        return [(s, min(s + step, rows)) for s in range(0, max(rows, 1), step)]
+
+    def agg(self, op: Callable, *others: 'Rolling', footprint: float = None):
         """
         Call `op` on the split rolling data one by one, pass in all the adjusted values,
-        and finally aggregate them into a whole.
+        and write the results into a whole.
+        :param footprint: estimated memory of `op` intermediates, in multiples of the window
+            data of inputs, used to plan the chunks, see `plan_split`.
         """
         assert all(r.win == self.win for r in others), '`others` must have same `win` with `self`'
-        seq = [op(self.adjusted(s, e), *[r.adjusted(s, e) for r in others]).contiguous()
-               for s, e in self.split]
-        return torch.cat(seq)
+        split = self.plan_split(*others, footprint=footprint)
+        ret = None
+        for s, e in split:
+            out = op(self.adjusted(s, e), *[r.adjusted(s, e) for r in others])
+            if len(split) == 1:
+                return out.contiguous()
+            if ret is None:
+                ret = out.new_empty((self.values.shape[0],) + out.shape[1:])
+            ret[s:e] = out
+        return ret
 
     def loc(self, i):
         if i == -1:
             # last doesn't need to adjust, just return directly
             return self.values[:, :, i]
-
-        def _loc(x):
-            return x[:, :, i]
-
-        return self.agg(_loc)
+        if self.adjustments is not None:
+            return self.adjusted_values[:, :, i] / self.adjustment_last[:, :, 0]
+        return self.values[:, :, i]
 
     def last(self):
         return self.loc(-1)
 
     def last_nonnan(self):
-        return self.agg(lambda x: nanlast(x, dim=2))
+        return self.agg(lambda x: nanlast(x, dim=2), footprint=1)
 
     def first(self):
         return self.loc(0)
 
+    # sum/mean/std of window axis are computed by prefix sums, fallback to unfold if not possible
+
     def sum(self, axis=2):
-        return self.agg(lambda x: x.sum(dim=axis))
+        if axis == 2:
+            ret = self._fast_nansum(full_window=True)
+            if ret is not None:
+                return ret
+        return self.agg(lambda x: x.sum(dim=axis), footprint=0)
 
     def nansum(self, axis=2):
-        return self.agg(lambda x: nansum(x, dim=axis))
+        if axis == 2:
+            ret = self._fast_nansum(full_window=False)
+            if ret is not None:
+                return ret
+        return self.agg(lambda x: nansum(x, dim=axis), footprint=1.25)
 
     def mean(self, axis=2):
-        return self.agg(lambda x: x.sum(dim=axis) / self.win)
+        if axis == 2:
+            ret = self._fast_nanmean(full_window=True)
+            if ret is not None:
+                return ret
+        return self.agg(lambda x: x.sum(dim=axis) / self.win, footprint=0)
 
     def nanmean(self, axis=2):
-        return self.agg(lambda x: nanmean(x, dim=axis))
+        if axis == 2:
+            ret = self._fast_nanmean(full_window=False)
+            if ret is not None:
+                return ret
+        return self.agg(lambda x: nanmean(x, dim=axis), footprint=1.25)
 
     def std(self, axis=2):
+        if axis == 2:
+            ret = self._fast_nanstd(full_window=True)
+            if ret is not None:
+                return ret
         # unbiased=False eq ddof=0
-        return self.agg(lambda x: x.std(unbiased=False, dim=axis))
+        return self.agg(lambda x: x.std(unbiased=False, dim=axis), footprint=1)
 
     def nanstd(self, axis=2):
-        return self.agg(lambda x: nanstd(x, dim=axis, ddof=0))
+        if axis == 2:
+            ret = self._fast_nanstd(full_window=False)
+            if ret is not None:
+                return ret
+        return self.agg(lambda x: nanstd(x, dim=axis, ddof=0), footprint=2.25)
+
+    # max/min are computed by van Herk/Gil-Werman algorithm, fallback to unfold if not possible
 
     def max(self):
-        return self.agg(lambda x: x.max(dim=2)[0])
+        ret = self._block_extrema(largest=True, full_window=True)
+        if ret is not None:
+            return ret
+        return self.agg(lambda x: x.max(dim=2)[0], footprint=0)
 
     def min(self):
-        return self.agg(lambda x: x.min(dim=2)[0])
+        ret = self._block_extrema(largest=False, full_window=True)
+        if ret is not None:
+            return ret
+        return self.agg(lambda x: x.min(dim=2)[0], footprint=0)
 
     def nanmax(self):
-        return self.agg(lambda x: nanmax(x, dim=2))
+        ret = self._block_extrema(largest=True, full_window=False)
+        if ret is not None:
+            return ret
+        return self.agg(lambda x: nanmax(x, dim=2), footprint=1.25)
 
     def nanmin(self):
-        return self.agg(lambda x: nanmin(x, dim=2))
+        ret = self._block_extrema(largest=False, full_window=False)
+        if ret is not None:
+            return ret
+        return self.agg(lambda x: nanmin(x, dim=2), footprint=1.25)
+
+    def nanrank(self, pct=False):
+        """
+        Rank of the last value in its window (ts_rank), 1 is the lowest, ties get the average
+        rank, nan is ignored. Counts comparisons with the last value, O(win) without sorting.
+        If `pct`, returns rank / count.
+        """
+        def _rank(x):
+            last = x[:, :, -1:]
+            less = (x < last).sum(dim=2)
+            equal = (x == last).sum(dim=2)
+            rank = less + (equal + 1) / 2
+            if pct:
+                rank = rank / (~torch.isnan(x)).sum(dim=2)
+            return rank.masked_fill_(torch.isnan(last[:, :, 0]), np.nan)
+        return self.agg(_rank, footprint=0.5)
+
+    def nanquantile(self, q: float):
+        """
+        Same as numpy nanquantile of each window. Windows without nan are computed by selection
+        (kthvalue) instead of sorting, others fallback to sort. Small windows are just sorted,
+        which is faster.
+        """
+        if self.win < Rolling._selection_win:
+            return self.agg(lambda x: nanquantile(x, q, dim=2), footprint=4)
+        pos = q * (self.win - 1)
+        lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+
+        def _quantile(x):
+            low = x.kthvalue(lo + 1, dim=2)[0]
+            if hi == lo:
+                ret = low
+            else:
+                # next order statistic: low itself if enough ties, or the min value above it
+                not_above = x <= low[:, :, None]
+                above = x.masked_fill(not_above, np.inf).min(dim=2)[0]
+                high = torch.where(not_above.sum(dim=2) > hi, low, above)
+                ret = low + (high - low) * (pos - lo)
+            partial = torch.isnan(x).any(dim=2)
+            if partial.any():
+                ret[partial] = nanquantile(x[partial], q, dim=1).to(ret.dtype)
+            return ret
+        return self.agg(_quantile, footprint=2.5)
+
+    def nanmedian(self):
+        return self.nanquantile(0.5)
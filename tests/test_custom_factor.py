@@ -1,6 +1,7 @@
 import unittest
 import spectre
 import numpy as np
+import pandas as pd
 from numpy.testing import assert_array_equal
 import torch
 from os.path import dirname
@@ -78,3 +79,60 @@ class TestCustomFactorLib(unittest.TestCase):
         self.assertEqual(0, test_f1._ref_count)
         assert_array_equal([0, 3, 1, 4, 2, 5], df['test1'].values)
         assert_array_equal([0, 3, 1, 7, 3, 12], df['test2'].values)
+
+    def test_common_subexpression(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+
+        class CountFactor(spectre.factors.CustomFactor):
+            inputs = [spectre.factors.OHLCV.close]
+            win = 2
+            calls = 0
+
+            def compute(self, close):
+                CountFactor.calls += 1
+                return close.nanmean()
+
+        engine.add(CountFactor(), 'a')
+        engine.add(CountFactor(inputs=(spectre.factors.OHLCV.close,)) + 1, 'b')
+        engine.add(CountFactor(win=3), 'c')
+        engine.add(CountFactor(win=3) - CountFactor(), 'd')
+        df = engine.run('2019-01-11', '2019-01-15')
+        self.assertEqual(2, CountFactor.calls)
+        assert_array_equal(df['a'] + 1, df['b'])
+        assert_array_equal(df['c'] - df['a'], df['d'])
+
+    def test_operator_fusion(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+
+        def build():
+            ma5 = spectre.factors.SMA(5)
+            ma20 = spectre.factors.SMA(20)
+            std = spectre.factors.STDDEV(20)
+            rsi = spectre.factors.RSI()
+            spread = (ma5 - ma20) / std
+            engine.clear()
+            engine.add(spread, 'spread')
+            engine.add((spread * 2 + 0.1).rank(), 'rank')
+            engine.add(-(ma5 ** 2).abs() / rsi, 'neg')
+            engine.add((spread > 0) & (rsi < 30) | ~(rsi >= 70), 'filter')
+            engine.set_filter(spectre.factors.OHLCV.volume.top(2) & (rsi != 50))
+
+        build()
+        expected = engine.run('2019-01-11', '2019-01-15')
+        build()
+        engine.set_operator_fusion(True)
+        result = engine.run('2019-01-11', '2019-01-15')
+        pd.testing.assert_frame_equal(expected, result, check_exact=True)
+
+        # spread is a column and used by rank, so not fused into rank
+        self.assertNotIsInstance(engine.get_factor('spread'), spectre.factors.FusedFactor)
+        self.assertIsInstance(engine.get_factor('rank').inputs[0],
+                              spectre.factors.FusedFactor)
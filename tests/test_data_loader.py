@@ -125,6 +125,57 @@ class TestDataLoaderLib(unittest.TestCase):
         engine.add(spectre.factors.DataFactor(inputs=['uOpen']), 'open')
         engine.run(start, end, delay_factor=False)
 
+    def test_reindex_product(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', calender_asset='AAPL', prices_index='date', parse_dates=True, )
+        df = loader.load(None, None, 0)
+        df = df.iloc[np.random.RandomState(0).rand(len(df)) > 0.1].copy()
+        df.index = df.index.remove_unused_levels()
+        df['flag'] = df['close'] > 100
+        df['sector'] = pd.Categorical(np.where(df['flag'], 'a', 'b'))
+        expected = df.reindex(pd.MultiIndex.from_product(df.index.levels))
+        result = spectre.data.DataLoader.reindex_product(df)
+        pd.testing.assert_frame_equal(expected, result)
+
+    def test_groupby_index(self):
+        import tempfile
+        import torch
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', calender_asset='AAPL', prices_index='date', parse_dates=True, )
+        with tempfile.TemporaryDirectory() as tmp:
+            spectre.data.ArrowLoader.ingest(loader, tmp + '/daily.feather')
+            self.assertTrue(os.path.isfile(tmp + '/daily.feather.idx.npz'))
+            loader = spectre.data.ArrowLoader(tmp + '/daily.feather')
+            for start, end, backwards in [('2019-01-01', '2019-01-15', 11),
+                                          ('2019-01-11', '2019-01-12', 0),
+                                          (None, None, 0)]:
+                df = loader.load(start and pd.Timestamp(start, tz='UTC'),
+                                 end and pd.Timestamp(end, tz='UTC'), backwards)
+                df.index = df.index.remove_unused_levels()
+                for group, keys in [('asset', df.index.codes[1]),
+                                    (loader.time_category, df[loader.time_category].values)]:
+                    sorted_indices, counts = loader.groupby_layout(df, group)
+                    expected = spectre.parallel.ParallelGroupBy(torch.tensor(keys))
+                    result = spectre.parallel.ParallelGroupBy.from_sorted(
+                        torch.from_numpy(sorted_indices), torch.from_numpy(counts))
+                    self.assertTrue(torch.equal(expected._sorted_indices, result._sorted_indices))
+                    self.assertTrue(torch.equal(expected._inverse_indices,
+                                                result._inverse_indices))
+            # filtered rows are not a date range
+            df = df.loc[(slice(None), 'AAPL'), :]
+            self.assertIsNone(loader.groupby_layout(df, 'asset'))
+
+            # engine result same as without index
+            engine = spectre.factors.FactorEngine(loader)
+            engine.add(spectre.factors.MA(3), 'ma')
+            engine.add(spectre.factors.RSI(), 'rsi')
+            result = engine.run('2019-01-11', '2019-01-15')
+            os.remove(tmp + '/daily.feather.idx.npz')
+            engine = spectre.factors.FactorEngine(spectre.data.ArrowLoader(tmp + '/daily.feather'))
+            engine.add(spectre.factors.MA(3), 'ma')
+            engine.add(spectre.factors.RSI(), 'rsi')
+            pd.testing.assert_frame_equal(result, engine.run('2019-01-11', '2019-01-15'))
+
     @unittest.skipUnless(os.getenv('COVERAGE_RUNNING'), "too slow, run manually")
     def test_yahoo(self):
         yahoo_path = data_dir + '/yahoo/'
@@ -1,10 +1,14 @@
 import unittest
+import tempfile
+import threading
+import json
 import spectre
 import os
 import numpy as np
 import pandas as pd
 import torch
 from numpy.testing import assert_almost_equal, assert_array_equal
+from multiprocessing.pool import ThreadPool
 from os.path import dirname
 
 data_dir = dirname(__file__) + '/data/'
@@ -17,6 +21,29 @@ class TestMultiProcessing(spectre.factors.CPUParallelFactor):
         return (a * b).mean(axis=0).values
 
 
+class UnsortedAssetLoader(spectre.data.DataLoader):
+    """ Asset level is not in the order of its categories, assets have the bars of `spans`. """
+
+    def __init__(self, spans=None) -> None:
+        super().__init__(None, adjustments=None)
+        self.spans = spans or {'ZZ': (0, 120), 'MM': (90, 110), 'AA': (10, 110),
+                               'QQ': (70, 100), 'BB': (5, 115), 'KK': (95, 120)}
+
+    def _load(self) -> pd.DataFrame:
+        dates = pd.date_range('2020-01-01', periods=120, freq='B', tz='UTC')
+        spans = self.spans
+        assets = pd.CategoricalIndex(list(spans), categories=sorted(spans), ordered=True)
+        date_codes, asset_codes = np.nonzero(
+            [[start <= d < end for start, end in spans.values()] for d in range(len(dates))])
+        index = pd.MultiIndex(levels=[dates, assets], codes=[date_codes, asset_codes],
+                              names=['date', 'asset'])
+        close = 10 + np.random.RandomState(0).rand(len(index)).cumsum()
+        df = pd.DataFrame(dict(open=close, high=close + 1, low=close - 1, close=close,
+                               volume=1000.), index=index)
+        df[self.time_category] = date_codes
+        return df
+
+
 class TestFactorLib(unittest.TestCase):
 
     def test_factors(self):
@@ -30,6 +57,7 @@ class TestFactorLib(unittest.TestCase):
         engine.add(spectre.factors.OHLCV.high, 'high')
         engine.add(spectre.factors.OHLCV.low, 'low')
         engine.add(spectre.factors.OHLCV.close, 'close')
+        engine.add(spectre.factors.OHLCV.volume, 'volume')
         df = engine.run('2018-01-01', '2019-01-15')
         df_aapl_close = df.loc[(slice(None), 'AAPL'), 'close']
         df_msft_close = df.loc[(slice(None), 'MSFT'), 'close']
@@ -37,6 +65,8 @@ class TestFactorLib(unittest.TestCase):
         df_msft_high = df.loc[(slice(None), 'MSFT'), 'high']
         df_aapl_low = df.loc[(slice(None), 'AAPL'), 'low']
         df_msft_low = df.loc[(slice(None), 'MSFT'), 'low']
+        df_aapl_volume = df.loc[(slice(None), 'AAPL'), 'volume'].astype(float)
+        df_msft_volume = df.loc[(slice(None), 'MSFT'), 'volume'].astype(float)
         engine.remove_all_factors()
         engine.add(spectre.factors.OHLCV.open, 'open')
         df = engine.run('2018-01-01', '2019-01-15', False)
@@ -135,6 +165,18 @@ class TestFactorLib(unittest.TestCase):
         test_expected(spectre.factors.OHLCV.close.demean(),
                       expected_aapl, expected_msft, total_rows)
 
+        # test groupby of rank and zscore
+        test_expected(spectre.factors.OHLCV.close.rank(groupby={'AAPL': 's1', 'MSFT': 's1'}),
+                      [2.] * 6 + [1.] + [2.] * 2, [1.] * 8, total_rows)
+        test_expected(spectre.factors.OHLCV.close.rank(ascending=False, groupby={'AAPL': 1}),
+                      [1.] * 9, [1.] * 8, total_rows)
+        expected_aapl = [1.] * 9
+        expected_aapl[6] = np.nan
+        test_expected(spectre.factors.OHLCV.close.zscore(groupby={'AAPL': 1, 'MSFT': 1}),
+                      expected_aapl, [-1.] * 8, total_rows)
+        test_expected(spectre.factors.OHLCV.close.zscore(groupby={'AAPL': 1, 'MSFT': 2}),
+                      [np.nan] * 9, [np.nan] * 8, total_rows)
+
         # test shift
         expected_aapl = df_aapl_close.shift(2)[-total_rows + 1:]
         expected_aapl[0:2] = np.nan
@@ -251,6 +293,26 @@ class TestFactorLib(unittest.TestCase):
                                      fastk_period=14)[0]
         test_expected(spectre.factors.STOCHF(), expected_aapl, expected_msft)
 
+        # test rolling rank and median
+        expected_aapl = df_aapl_close.rolling(10).rank().values
+        expected_msft = df_msft_close.rolling(10).rank().values
+        test_expected(spectre.factors.TS_RANK(10), expected_aapl, expected_msft)
+        expected_aapl = df_aapl_close.rolling(10).median().values
+        expected_msft = df_msft_close.rolling(10).median().values
+        test_expected(spectre.factors.RollingMedian(10), expected_aapl, expected_msft)
+
+        # test wilder's smoothing
+        aapl = (df_aapl_high.values, df_aapl_low.values, df_aapl_close.values)
+        msft = (df_msft_high.values, df_msft_low.values, df_msft_close.values)
+        test_expected(spectre.factors.WilderRSI(), talib.RSI(aapl[2], timeperiod=14),
+                      talib.RSI(msft[2], timeperiod=14), decimal=2)
+        test_expected(spectre.factors.ATR(), talib.ATR(*aapl, timeperiod=14),
+                      talib.ATR(*msft, timeperiod=14), decimal=2)
+        test_expected(spectre.factors.ADX(), talib.ADX(*aapl, timeperiod=14),
+                      talib.ADX(*msft, timeperiod=14), decimal=1)
+        test_expected(spectre.factors.ADOSC(), talib.ADOSC(*aapl, df_aapl_volume.values),
+                      talib.ADOSC(*msft, df_msft_volume.values), decimal=-4)
+
         # test same factor only compute once, and nest factor window
         f1 = spectre.factors.BBANDS(win=20, inputs=[spectre.factors.OHLCV.close, 2])
         f2 = spectre.factors.EMA(win=10, inputs=[f1])
@@ -411,6 +473,13 @@ class TestFactorLib(unittest.TestCase):
         expected = pd.qcut(data[1], 5, labels=False) + 1
         assert_array_equal(result[-1], expected)
 
+        # groupby, same as compute each group separately
+        data = torch.tensor([[-1, 3, 1, -4, np.nan, 5, 1.01, 1.01, 1.02, np.nan, 2, 1.01]])
+        groups = torch.tensor([[0, 1., 0, 1, 0, 1, 0, 1, 0, 1, 0, 1]])
+        result = f.compute(data, groups)
+        expected = [[1, 4, 2, 1, np.nan, 5, 3, 2, 4, np.nan, 5, 2]]
+        assert_array_equal(result, expected)
+
     def test_align_by_time(self):
         loader = spectre.data.CsvDirLoader(
             data_dir + '/daily/', calender_asset='AAPL',
@@ -441,6 +510,60 @@ class TestFactorLib(unittest.TestCase):
         self.assertEqual(df.loc[("2019-01-11", 'MSFT'), 'ma'].values,
                          df.loc[("2019-01-10", 'MSFT'), 'close'].values)
 
+    def test_aligned_groupby(self):
+        for loader_align, engine_align in [(True, False), (False, True)]:
+            loader = spectre.data.CsvDirLoader(
+                data_dir + '/daily/', calender_asset='AAPL',
+                ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+                prices_index='date', parse_dates=True, align_by_time=loader_align
+            )
+            engine = spectre.factors.FactorEngine(loader)
+            engine.set_align_by_time(engine_align)
+            engine.add(spectre.factors.SMA(3), 'ma')
+            engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+            mixed = spectre.factors.OHLCV.close.zscore() + spectre.factors.OHLCV.close
+            engine.add(spectre.factors.SMA(2, inputs=[mixed]), 'mixed')
+            engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+            result = engine.run("2019-01-01", "2019-01-15")
+            self.assertIsInstance(engine.get_group_('asset'), spectre.parallel.AlignedGroupBy)
+            self.assertIsInstance(engine.get_group_('date'), spectre.parallel.AlignedGroupBy)
+
+            engine._get_grid_shape = lambda df: None
+            engine._prepared.clear()
+            expected = engine.run("2019-01-01", "2019-01-15")
+            self.assertNotIsInstance(engine.get_group_('asset'), spectre.parallel.AlignedGroupBy)
+            pd.testing.assert_frame_equal(expected, result)
+
+        # grid in the order of level codes, asset level is unsorted
+        loader = UnsortedAssetLoader({asset: (0, 120) for asset in ('ZZ', 'MM', 'AA')})
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.SMA(3), 'ma')
+        engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+        engine.set_asset_shards(2)
+        result = engine.run('2020-02-03', '2020-06-16')
+        self.assertIsInstance(engine.get_group_('asset'), spectre.parallel.AlignedGroupBy)
+        engine._get_grid_shape = lambda df: None
+        engine._prepared.clear()
+        engine.set_asset_shards(None)
+        pd.testing.assert_frame_equal(engine.run('2020-02-03', '2020-06-16'), result)
+
+        # in-place ops do not modify the data cached by engine
+        class InplaceDouble(spectre.factors.CustomFactor):
+            def compute(self, x):
+                return x.mul_(2)
+
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', calender_asset='AAPL',
+            ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        engine.set_align_by_time(True)
+        engine.add(InplaceDouble(inputs=[spectre.factors.OHLCV.close]), 'double')
+        expected = engine.run('2019-01-01', '2019-01-15')
+        self.assertIsInstance(engine.get_group_('asset'), spectre.parallel.AlignedGroupBy)
+        pd.testing.assert_frame_equal(expected, engine.run('2019-01-01', '2019-01-15'))
+
     def test_linear_regression(self):
         loader = spectre.data.CsvDirLoader(
             data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
@@ -484,6 +607,416 @@ class TestFactorLib(unittest.TestCase):
 
         assert_array_equal(result.f[result['mask']], result2.f)
 
+    def test_incremental_run(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', calender_asset='AAPL',
+            ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+
+        def build_engine(recursive=False):
+            _engine = spectre.factors.FactorEngine(loader)
+            _engine.add(spectre.factors.SMA(3), 'ma')
+            _engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+            if recursive:
+                _engine.add(spectre.factors.EMA(5), 'ema')
+                _engine.add(spectre.factors.MACD(), 'macd')
+                _engine.add(spectre.factors.RSI(), 'rsi')
+            _engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+            return _engine
+
+        for delay in (True, False):
+            engine = build_engine()
+            engine.set_incremental(True)
+            engine.run('2019-01-02', '2019-01-09', delay)
+            loaded = []
+            load = loader.load
+            loader.load = lambda *args: loaded.append(load(*args)) or loaded[-1]
+            try:
+                result = engine.run('2019-01-03', '2019-01-15', delay)
+            finally:
+                loader.load = load
+            # only new bars and its backward data are loaded
+            self.assertEqual(pd.Timestamp('2019-01-07', tz='UTC'),
+                             engine.dataframe_.index.levels[0][0])
+            self.assertEqual(1, len(loaded))
+            self.assertEqual(len(engine.dataframe_), len(loaded[0]))
+            expected = build_engine().run('2019-01-03', '2019-01-15', delay)
+            pd.testing.assert_frame_equal(expected, result)
+
+            # recursive factors start from their window, not the loaded history
+            engine = build_engine(True)
+            engine.set_incremental(True)
+            engine.run('2019-01-02', '2019-01-09', delay)
+            result = engine.run('2019-01-03', '2019-01-15', delay)
+            expected = build_engine(True).run('2019-01-03', '2019-01-15', delay)
+            pd.testing.assert_frame_equal(expected, result, check_exact=False, rtol=1e-12)
+
+    def test_chunked_run(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', calender_asset='AAPL',
+            ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.SMA(3), 'ma')
+        engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+        # recursive factors start from their window, not the loaded history
+        engine.add(spectre.factors.EMA(5), 'ema')
+        engine.add(spectre.factors.MACD(), 'macd')
+        engine.add(spectre.factors.RSI(), 'rsi')
+        engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+
+        for delay in (True, False):
+            engine.set_chunk_size(None)
+            expected = engine.run('2019-01-03', '2019-01-15', delay)
+            for bars in (1, 3, 100):
+                engine.set_chunk_size(bars)
+                result = engine.run('2019-01-03', '2019-01-15', delay)
+                pd.testing.assert_frame_equal(expected, result, check_exact=False, rtol=1e-12)
+
+        # each chunk only loads its own dates and the overlap, not the whole history
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.SMA(3), 'ma')
+        expected = engine.run('2018-06-01', '2019-01-15', False)
+        loaded = []
+        load = loader.load
+        loader.load = lambda *args: loaded.append(load(*args)) or loaded[-1]
+        try:
+            engine.set_chunk_size(2)
+            result = engine.run('2018-06-01', '2019-01-15', False)
+        finally:
+            loader.load = load
+        pd.testing.assert_frame_equal(expected, result)
+        self.assertLess(sum(len(df) for df in loaded), 4 * len(expected))
+
+    def test_asset_shards(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        ma = spectre.factors.SMA(3)
+        engine.add(ma, 'ma')
+        engine.add(ma.rank(), 'rank')
+        engine.add(spectre.factors.EMA(5).zscore() + spectre.factors.RSI(), 'mixed')
+        engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+        expected = engine.run('2019-01-03', '2019-01-15')
+
+        self.assertEqual(3, len(engine._get_asset_frontier(
+            [ma, ma.rank(), spectre.factors.EMA(5).zscore() + spectre.factors.RSI()])))
+        for multiprocess in (False, True):
+            engine.set_asset_shards(2, multiprocess, 2)
+            result = engine.run('2019-01-03', '2019-01-15')
+            pd.testing.assert_frame_equal(expected, result)
+
+        # length buckets
+        buckets = engine._get_length_buckets(np.array([20, 5000, 17, 4096, 1, 32]))
+        self.assertEqual([[4], [0, 2, 5], [3], [1]], [list(b) for b in buckets])
+        engine.set_asset_shards(None)
+        engine.set_length_buckets(True)
+        result = engine.run('2019-01-03', '2019-01-15')
+        pd.testing.assert_frame_equal(expected, result)
+
+        # rows of shards are in the order of asset group
+        engine = spectre.factors.FactorEngine(UnsortedAssetLoader())
+        engine.add(spectre.factors.OHLCV.close + 0, 'close')
+        engine.add(spectre.factors.SMA(5), 'ma')
+        engine.set_filter(spectre.factors.OHLCV.close > 20)
+        expected = engine.run('2020-02-03', '2020-06-16', False)
+        engine.set_asset_shards(4)
+        result = engine.run('2020-02-03', '2020-06-16', False)
+        pd.testing.assert_frame_equal(expected, result)
+        engine.set_asset_shards(None)
+        engine.set_length_buckets(True)
+        result = engine.run('2020-02-03', '2020-06-16', False)
+        pd.testing.assert_frame_equal(expected, result)
+
+    def test_cpu_workers(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        f = spectre.factors.MACD() + spectre.factors.RSI() + spectre.factors.STOCHF()
+        engine.add(f.rank().zscore(), 'f')
+        engine.add(spectre.factors.BBANDS() * spectre.factors.SMA(3), 'bb')
+        engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+        expected = engine.run('2019-01-03', '2019-01-15')
+
+        engine.set_cpu_workers(4)
+        result = engine.run('2019-01-03', '2019-01-15')
+        pd.testing.assert_frame_equal(expected, result)
+
+    def test_profiling(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        ma = spectre.factors.SMA(3)
+        engine.add(ma, 'ma')
+        engine.add(ma.rank(), 'rank')
+        engine.set_profiling(True)
+        engine.run('2019-01-03', '2019-01-15', False)
+
+        df = engine.profiler.to_dataframe()
+        stages = set(df.name[df.category == 'stage'])
+        for stage in ('prepare_tensor', 'groupby:asset', 'groupby:date', 'revert', 'assembly'):
+            self.assertIn(stage, stages)
+        factors = df[df.category == 'factor']
+        # ma is computed once, then hit the cache when used as a column
+        ma_events = factors[factors.name == 'SimpleMovingAverage']
+        self.assertEqual([False, True], ma_events.cache_hit.tolist())
+        self.assertTrue((factors.output_bytes > 0).all())
+        self.assertTrue((df.wall_time >= 0).all())
+        self.assertTrue(df.memory_estimated.all())
+
+        trace = json.loads(engine.profiler.to_chrome_trace())
+        self.assertEqual(len(df), len(trace['traceEvents']))
+        self.assertEqual('X', trace['traceEvents'][0]['ph'])
+
+        # clear on every run, data is reused so no groupby
+        engine.run('2019-01-03', '2019-01-15', False)
+        df2 = engine.profiler.to_dataframe()
+        self.assertEqual(len(factors), (df2.category == 'factor').sum())
+        self.assertNotIn('groupby:asset', set(df2.name))
+
+        # a root is recorded once, not again as a cache hit
+        engine.remove_all_factors()
+        engine.add(spectre.factors.RSI(), 'rsi')
+        engine.run('2019-01-03', '2019-01-15', False)
+        df = engine.profiler.to_dataframe()
+        rsi_events = df[df.name == type(spectre.factors.RSI()).__name__]
+        self.assertEqual([False], rsi_events.cache_hit.tolist())
+
+    def test_output_mode(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.SMA(3), 'ma')
+        engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+        engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+
+        for delay in (True, False):
+            expected = engine.run('2019-01-03', '2019-01-15', delay)
+
+            ret = engine.run('2019-01-03', '2019-01-15', delay, output='tensor')
+            self.assertIsInstance(ret['ma'], torch.Tensor)
+            mask = ret.mask.cpu().numpy()
+            assert_array_equal(expected.index, ret.index[mask])
+            assert_array_equal(expected.ma, ret['ma'].cpu().numpy()[mask])
+
+            ret = engine.run('2019-01-03', '2019-01-15', delay, output='numpy')
+            assert_array_equal(expected['rank'], ret['rank'][ret.mask])
+
+            ret = engine.run('2019-01-03', '2019-01-15', delay, output='wide')
+            wide = expected.ma.unstack().reindex(index=ret.dates, columns=ret.assets)
+            ma = ret['ma'].cpu().numpy()
+            ma[~ret.mask.cpu().numpy()] = np.nan
+            assert_array_equal(wide.values, ma)
+
+        engine.set_chunk_size(2)
+        self.assertRaises(ValueError, engine.run, '2019-01-03', '2019-01-15', output='numpy')
+
+    def test_prepared_cache(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.SMA(3), 'ma')
+        engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+        expected_train = engine.run('2019-01-03', '2019-01-08')
+        expected_test = engine.run('2019-01-09', '2019-01-15')
+        expected_sub = engine.run('2019-01-10', '2019-01-14')
+
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.SMA(3), 'ma')
+        engine.add(spectre.factors.OHLCV.close.rank(), 'rank')
+        engine.run('2019-01-03', '2019-01-08')
+        engine.run('2019-01-09', '2019-01-15')
+        loaded = []
+        load = loader.load
+        loader.load = lambda *args: loaded.append(args) or load(*args)
+        try:
+            # switch between ranges
+            pd.testing.assert_frame_equal(expected_train, engine.run('2019-01-03', '2019-01-08'))
+            pd.testing.assert_frame_equal(expected_test, engine.run('2019-01-09', '2019-01-15'))
+            # sub range
+            pd.testing.assert_frame_equal(expected_sub, engine.run('2019-01-10', '2019-01-14'))
+            self.assertEqual(0, len(loaded))
+            # capacity is 2, train range is evicted
+            engine.run('2019-01-03', '2019-01-08')
+            self.assertEqual(1, len(loaded))
+        finally:
+            loader.load = load
+
+        # loader without `last_modified`, prepared data are not kept
+        engine = spectre.factors.FactorEngine(UnsortedAssetLoader())
+        engine.add(spectre.factors.SMA(3), 'ma')
+        expected = engine.run('2020-02-03', '2020-06-16', False)
+        pd.testing.assert_frame_equal(expected, engine.run('2020-02-03', '2020-06-16', False))
+        self.assertEqual(0, len(engine._prepared))
+
+    def test_result_cache(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+
+        calls = []
+
+        class CountFactor(spectre.factors.CustomFactor):
+            inputs = [spectre.factors.OHLCV.close]
+
+            def compute(self, data):
+                calls.append(1)
+                return data * 2
+
+        with tempfile.TemporaryDirectory() as path:
+            results = []
+            for _ in range(2):
+                engine = spectre.factors.FactorEngine(loader)
+                engine.set_result_cache(path)
+                engine.add(CountFactor(), 'f')
+                engine.add(spectre.factors.SMA(3), 'ma')
+                engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+                results.append(engine.run('2019-01-03', '2019-01-15'))
+            self.assertEqual(1, len(calls))
+            pd.testing.assert_frame_equal(results[0], results[1])
+
+            # different date range is another cache file
+            engine.run('2019-01-04', '2019-01-15')
+            self.assertEqual(2, len(calls))
+
+            # the code of parallel algorithms is a part of the key
+            cache = spectre.factors.cache
+            key = (spectre.factors.SMA, 3)
+            digest = cache.FactorResultCache.digest(key, ())
+            fingerprint = cache._library_fingerprint
+            cache._library_fingerprint = lambda: b'modified'
+            try:
+                self.assertNotEqual(digest, cache.FactorResultCache.digest(key, ()))
+            finally:
+                cache._library_fingerprint = fingerprint
+
+            # loader without `last_modified`, results are not cached
+            for _ in range(2):
+                engine = spectre.factors.FactorEngine(UnsortedAssetLoader())
+                engine.set_result_cache(path)
+                engine.add(CountFactor(), 'f')
+                engine.run('2020-02-03', '2020-06-16')
+            self.assertEqual(4, len(calls))
+
+    def test_execution_plan(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+
+        def chain_peak(length):
+            f = spectre.factors.OHLCV.close
+            for _ in range(length):
+                f = spectre.factors.SMA(3, inputs=[f])
+            engine.remove_all_factors()
+            engine.add(f, 'f')
+            engine.run("2019-01-01", "2019-01-15", False)
+            self.assertGreater(engine.planned_peak_memory, 0)
+            return engine.planned_peak_memory
+
+        # intermediate results are released after consumed, so peak not grow with length
+        peak6 = chain_peak(6)
+        peak2 = chain_peak(2)  # same data as last run
+        self.assertEqual(peak2, peak6)
+
+        # plan without computing, same as the plan of run
+        calls = []
+
+        class CountFactor(spectre.factors.CustomFactor):
+            inputs = [spectre.factors.OHLCV.close]
+
+            def compute(self, data):
+                calls.append(1)
+                return data * 2
+
+        ma = spectre.factors.SMA(3, inputs=[CountFactor()])
+        engine.remove_all_factors()
+        engine.add(ma, 'ma')
+        engine.add(ma.rank(), 'rank')
+        engine.set_filter(spectre.factors.OHLCV.volume.top(1))
+        steps, peak = engine.plan("2019-01-01", "2019-01-15")
+        self.assertEqual(0, len(calls))
+        self.assertEqual(['ma', 'rank', None], list(steps))
+        self.assertEqual(['CountFactor', 'SimpleMovingAverage', 'ShiftFactor'],
+                         [type(f).__name__ for f in steps['ma']])
+        engine.run("2019-01-01", "2019-01-15")
+        self.assertEqual(peak, engine.planned_peak_memory)
+
+    def test_memory_budget(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        engine.add(spectre.factors.RSI(), 'rsi')
+        engine.add(spectre.factors.BBANDS(), 'bbands')
+        expected = engine.run("2019-01-01", "2019-01-15")
+        engine.set_memory_budget(1)
+        assert_almost_equal(expected.values, engine.run("2019-01-01", "2019-01-15").values)
+        engine.set_memory_budget(None)
+
+    def test_shared_rolling(self):
+        loader = spectre.data.CsvDirLoader(
+            data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
+            prices_index='date', parse_dates=True,
+        )
+        engine = spectre.factors.FactorEngine(loader)
+        seen = []
+
+        class Probe(spectre.factors.CustomFactor):
+            def __init__(self, win, power):
+                super().__init__(win, [spectre.factors.OHLCV.close])
+                self.power = power
+
+            def compute(self, data):
+                seen.append(data)
+                return data.nanmean() ** self.power
+
+        engine.add(Probe(5, 1), 'p1')
+        engine.add(Probe(5, 2), 'p2')
+        engine.add(Probe(3, 1), 'p3')
+        engine.add(spectre.factors.SMA(5), 'sma')
+        df = engine.run("2019-01-01", "2019-01-15", False)
+        # same input and window built once, and released after run
+        win5 = [data for data in seen if data.win == 5]
+        win3 = [data for data in seen if data.win == 3]
+        self.assertIs(win5[0], win5[1])
+        self.assertIsNot(win5[0], win3[0])
+        self.assertEqual({}, engine._rolling_cache)
+        assert_almost_equal(df.p1.values, df.sma.values)
+        assert_almost_equal(df.p1.values ** 2, df.p2.values)
+
+        # different keys build in parallel, same key builds once
+        barrier = threading.Barrier(2, timeout=10)
+        builds = []
+
+        def build():
+            builds.append(1)
+            barrier.wait()
+            return spectre.parallel.Rolling(torch.zeros(2, 5), 3)
+
+        for key in ('a', 'a', 'b'):
+            engine.share_rolling_(key)
+        with ThreadPool(3) as pool:
+            ret = pool.map(lambda k: engine.rolling_(k, build), ('a', 'a', 'b'))
+        self.assertEqual(2, len(builds))
+        self.assertIs(ret[0], ret[1])
+        self.assertEqual({}, engine._rolling_cache)
+
     def test_ref_count(self):
         loader = spectre.data.CsvDirLoader(
             data_dir + '/daily/', ohlcv=('uOpen', 'uHigh', 'uLow', 'uClose', 'uVolume'),
@@ -19,6 +19,19 @@ class TestParallelAlgorithm(unittest.TestCase):
         revert_x = groupby.revert(groups)
         assert_array_equal(revert_x.tolist(), test_x.tolist())
 
+        # random keys, compare with a simple implementation
+        test_k = torch.randint(-1, 50, (1000,))
+        test_x = torch.rand(1000, dtype=torch.float64)
+        groupby = spectre.parallel.ParallelGroupBy(test_k)
+        groups = groupby.split(test_x)
+        keys = np.unique(test_k.numpy())
+        self.assertEqual(len(keys), groups.shape[0])
+        for i, k in enumerate(keys):
+            expected = test_x.numpy()[test_k.numpy() == k]
+            assert_array_equal(expected, groups[i, :len(expected)].numpy())
+            self.assertTrue(np.isnan(groups[i, len(expected):].numpy()).all())
+        assert_array_equal(test_x.numpy(), groupby.revert(groups).numpy())
+
     def test_rolling(self):
         x = torch.tensor([[164.0000, 163.7100, 158.6100, 145.230],
                           [104.6100, 104.4200, 101.3000, 102.280]])
@@ -52,6 +65,86 @@ class TestParallelAlgorithm(unittest.TestCase):
         x = torch.zeros([1024, 102400], dtype=torch.float64)
         spectre.parallel.Rolling(x, 252).sum()
 
+        # prefix sum and block max backend same as unfold
+        x = torch.randn(20, 300, dtype=torch.float64) * 10 + 100
+        x[torch.rand(20, 300) < 0.1] = np.nan
+        x[3, 100:] = np.nan
+        x[4, 50:80] = 100.5
+        y = torch.rand(20, 300) * 0.2 + 0.9
+        y[torch.rand(20, 300) < 0.05] = np.nan
+        for adj in (None, y):
+            for win in (2, 20, 250):
+                r = spectre.parallel.Rolling(x, win, adj)
+                for fast, slow in [
+                        (r.sum(), lambda v: v.sum(dim=2)),
+                        (r.nansum(), lambda v: spectre.parallel.nansum(v, dim=2)),
+                        (r.mean(), lambda v: v.sum(dim=2) / win),
+                        (r.nanmean(), lambda v: spectre.parallel.nanmean(v, dim=2)),
+                        (r.std(), lambda v: v.std(unbiased=False, dim=2)),
+                        (r.nanstd(), lambda v: spectre.parallel.nanstd(v, dim=2)),
+                        (r.max(), lambda v: v.max(dim=2)[0]),
+                        (r.min(), lambda v: v.min(dim=2)[0]),
+                        (r.nanmax(), lambda v: spectre.parallel.nanmax(v, dim=2)),
+                        (r.nanmin(), lambda v: spectre.parallel.nanmin(v, dim=2))]:
+                    assert_almost_equal(r.agg(slow).numpy(), fast.numpy(), decimal=10)
+                r2 = spectre.parallel.Rolling(x.flip(1), win)
+                assert_almost_equal(
+                    r.agg(lambda a, b: spectre.parallel.nanmean(a * b, dim=2), r2).numpy(),
+                    (r * r2).nanmean().numpy(), decimal=8)
+        # adjustments multiplied on series once, same as adjusting each window
+        r = spectre.parallel.Rolling(x, 20, y)
+        windows = r.values * r.adjustments / r.adjustment_last
+        assert_almost_equal(windows.numpy(), r.adjusted().numpy())
+        assert_almost_equal(windows[:, :, 0].numpy(), r.first().numpy())
+
+        # chunks planned by memory budget, same result
+        r = spectre.parallel.Rolling(x, 20, y)
+        expected = r.agg(lambda v: spectre.parallel.nanmean(v, dim=2))
+        r.memory_budget = 1
+        self.assertEqual(x.shape[0], len(r.plan_split()))
+        assert_almost_equal(expected.numpy(),
+                            r.agg(lambda v: spectre.parallel.nanmean(v, dim=2)).numpy())
+        r.memory_budget = 20 * 300 * 8 * 2 * 4 * 3
+        self.assertEqual(7, len(r.plan_split(r)))
+        assert_almost_equal(expected.numpy(),
+                            r.agg(lambda a, b: spectre.parallel.nanmean(a, dim=2), r).numpy())
+        # footprint of op, plus the adjusted copies of inputs
+        r.memory_budget = 20 * 300 * 8 * 2 * 3
+        self.assertEqual(7, len(r.plan_split(footprint=1)))
+        self.assertEqual(4, len(r.plan_split(footprint=0)))
+        assert_almost_equal(expected.numpy(), r.agg(
+            lambda v: spectre.parallel.nanmean(v, dim=2), footprint=1).numpy())
+
+        # inf fallback to unfold
+        x[0, 10] = np.inf
+        r = spectre.parallel.Rolling(x, 3)
+        assert_almost_equal(r.agg(lambda v: spectre.parallel.nanmean(v, dim=2)).numpy(),
+                            r.nanmean().numpy())
+
+    def test_rolling_rank(self):
+        import pandas as pd
+        x = torch.randn(6, 300, dtype=torch.float64)
+        x[torch.rand(6, 300) < 0.1] = np.nan
+        x[2, 100:] = np.nan
+        x[3] = torch.randint(0, 5, (300,)).double()  # ties
+        for win in (2, 5, 20, 40, 41):
+            r = spectre.parallel.Rolling(x, win)
+            df = pd.DataFrame(x.numpy().T).rolling(win, min_periods=1)
+            assert_almost_equal(df.rank().values.T, r.nanrank().numpy())
+            assert_almost_equal(df.rank(pct=True).values.T, r.nanrank(pct=True).numpy())
+            assert_almost_equal(df.median().values.T, r.nanmedian().numpy())
+            assert_almost_equal(df.quantile(0.3).values.T, r.nanquantile(0.3).numpy())
+
+        # adjusted, same as the naive sort of adjusted windows
+        y = torch.rand(6, 300, dtype=torch.float64) + 0.5
+        r = spectre.parallel.Rolling(x, 40, y)
+        expected = r.agg(lambda v: (v < v[:, :, -1:]).sum(dim=2) + 1 +
+                         ((v == v[:, :, -1:]).sum(dim=2) - 1) / 2)
+        expected[torch.isnan(x)] = np.nan
+        assert_almost_equal(expected.numpy(), r.nanrank().numpy())
+        assert_almost_equal(r.agg(lambda v: spectre.parallel.nanquantile(v, 0.7, dim=2)).numpy(),
+                            r.nanquantile(0.7).numpy())
+
     def test_nan(self):
         # dim=1
         data = [[1, 2, 1], [4, np.nan, 2], [7, 8, 1]]
@@ -119,3 +212,42 @@ class TestParallelAlgorithm(unittest.TestCase):
         for i in range(3):
             expected, _ = stats.pearsonr(x[i], y[i])
             assert_almost_equal(expected, result[i], decimal=6)
+
+    def test_linear_scan(self):
+        x = torch.randn(3, 1000, dtype=torch.float64)
+        decay = torch.rand(3, 1000, dtype=torch.float64) * 0.9 + 0.1
+        expected = np.zeros(x.shape)
+        for t in range(x.shape[1]):
+            expected[:, t] = x[:, t].numpy() + decay[:, t].numpy() * expected[:, t - 1] * (t > 0)
+        assert_almost_equal(expected, spectre.parallel.linear_scan(x, decay).numpy())
+
+        # zero decay restarts the recurrence
+        decay[torch.rand(3, 1000) < 0.1] = 0
+        expected = np.zeros(x.shape)
+        for t in range(x.shape[1]):
+            expected[:, t] = x[:, t].numpy() + decay[:, t].numpy() * expected[:, t - 1] * (t > 0)
+        assert_almost_equal(expected, spectre.parallel.linear_scan(x, decay).numpy())
+        assert_array_equal(x.numpy(), spectre.parallel.linear_scan(x, torch.zeros_like(x)).numpy())
+
+        # ema is exact, nan skipped
+        import pandas as pd
+        x = torch.randn(3, 2000, dtype=torch.float64).cumsum(dim=1) + 100
+        x[torch.rand(3, 2000) < 0.1] = np.nan
+        x[1, :50] = np.nan
+        for span in (2, 50, 500):
+            for adjust in (False, True):
+                result = spectre.parallel.nanema(x, 2 / (span + 1), adjust)
+                expected = [pd.Series(row).ewm(span=span, adjust=adjust, ignore_na=True).mean()
+                            for row in x.numpy()]
+                assert_almost_equal(np.array(expected), result.numpy(), decimal=10)
+                # factor starts recursion from its window
+                f = spectre.factors.EMA(span, adjust=adjust)
+                result = f.compute(spectre.parallel.Rolling(x, f.win))
+                for t in (0, 30, 1000, 1999):
+                    expected = [pd.Series(row[max(t - f.win + 1, 0):t + 1])
+                                .ewm(span=span, adjust=adjust, ignore_na=True).mean().iloc[-1]
+                                for row in x.numpy()]
+                    assert_almost_equal(expected, result[:, t].numpy(), decimal=10)
+        # alpha 1 is the last non-nan value
+        expected = [pd.Series(row).ewm(alpha=1, ignore_na=True).mean() for row in x.numpy()]
+        assert_array_equal(np.array(expected), spectre.parallel.nanema(x, 1.).numpy())